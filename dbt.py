@@ -2,77 +2,192 @@
 
 import argparse
 import importlib
-import ntpath
 import os
-import subprocess
+import shutil
 import sys
 import textwrap
-from distutils.dir_util import copy_tree
 from pathlib import Path
 
 PROG_NAME = sys.argv[0].split(".")[0]
+LAUNCH_ARGV = list(sys.argv)
 
 SCRIPTS_DIR = Path("./scripts")
 TASKS_DIR = SCRIPTS_DIR / "tasks"
 DBT_DEBUG_DIR = SCRIPTS_DIR / "debug"
 
-os.environ["DBT_DEBUG_DIR"] = str(DBT_DEBUG_DIR)
-os.environ["DELUGE_FW_ROOT"] = str(Path(".").resolve())
-
-if not "DBT_TOOLCHAIN_PATH" in os.environ:
-    os.environ["DBT_TOOLCHAIN_PATH"] = os.environ["DELUGE_FW_ROOT"]
-
 sys.path.append(str(TASKS_DIR))
 sys.path.insert(0, str(SCRIPTS_DIR))
 
-import util
+import profiler
+
+# `dbt --profile[=<file>] <subcommand> ...` records startup and task timings as JSON
+PROFILE_PATH = None
+if len(sys.argv) > 1 and sys.argv[1].split("=")[0] == "--profile":
+    PROFILE_PATH = sys.argv.pop(1).partition("=")[2] or None
+    profiler.install()
+
+with profiler.phase("environment"):
+    os.environ["DBT_DEBUG_DIR"] = str(DBT_DEBUG_DIR)
+    os.environ["DELUGE_FW_ROOT"] = str(Path(".").resolve())
+
+    if not "DBT_TOOLCHAIN_PATH" in os.environ:
+        os.environ["DBT_TOOLCHAIN_PATH"] = os.environ["DELUGE_FW_ROOT"]
+
+    import util
+
+    util.get_context()
+
+import pipeline
+
+
+# Bump when the environment snapshot layout changes
+ENV_SNAPSHOT_VERSION = 1
+# set by ./dbt to have setup() apply the environment instead of sourcing dbtenv.sh
+ENV_SNAPSHOT_REQUEST = "DBT_ENV_SNAPSHOT"
+# set once it has been applied, so nested dbt runs don't apply it again
+ENV_SNAPSHOT_APPLIED = "DBT_ENV_SNAPSHOT_APPLIED"
 
 
 def setup():
-    if sys.platform == "win32" or (sys.platform == "cosmo" and cosmo.kernel == "nt"):
-        dbtenvcmd = str(SCRIPTS_DIR / "toolchain" / "dbtenv.cmd").replace(
-            os.sep, ntpath.sep
-        )
-        dbtenv = util.get_environment_from_batch_command([dbtenvcmd, "env"])
-        # print("Setup Windows DBT Env")
+    """Apply the toolchain environment, re-running dbtenv.sh only when the required
+    toolchain version or the env script itself changed. POSIX only: dbt.cmd still
+    calls dbtenv.cmd itself."""
+    dbtenvcmd = str(SCRIPTS_DIR / "toolchain" / "dbtenv.sh")
+
+    context = util.get_context()
+    key = [
+        ENV_SNAPSHOT_VERSION,
+        sys.platform,
+        context.toolchain_version,
+        str(context.toolchain_path),
+        util.file_hash(dbtenvcmd),
+    ]
+
+    snapshot_path = util.get_cache_dir() / "environment.json"
+    snapshot = util.read_json_cache(snapshot_path, {})
+    if snapshot.get("key") == key and context.toolchain_dir.exists():
+        util.apply_environment_delta(snapshot["delta"])
     else:
-        dbtenvcmd = str(SCRIPTS_DIR / "toolchain" / "dbtenv.sh").encode()
-        subprocess.run([b"bash", dbtenvcmd])
+        before = dict(os.environ)
+        dbtenv = util.get_environment_from_shell_script(dbtenvcmd)
+        if dbtenv is None:
+            util.note(f"{PROG_NAME}: failed to set up the toolchain ({dbtenvcmd})")
+            sys.exit(1)
+        delta = util.environment_delta(before, dbtenv)
+        util.apply_environment_delta(delta)
+        util.write_json_cache(snapshot_path, {"key": key, "delta": delta})
+    os.environ[ENV_SNAPSHOT_APPLIED] = "1"
+
+
+def use_toolchain_python():
+    """Re-run dbt with the toolchain's python if it isn't the one running now, and
+    tell ./dbt which one to start next time."""
+    python = shutil.which("python3")
+    if not python:
+        return
+    marker = util.get_cache_dir() / "environment.python"
+    try:
+        recorded = marker.read_text()
+    except OSError:
+        recorded = None
+    if recorded != python:
+        marker.write_text(python)
+    if os.path.realpath(python) != os.path.realpath(sys.executable):
+        os.execv(python, [python] + LAUNCH_ARGV)
 
 
 def setup_ide_configs():
     if not os.path.exists(".vscode"):
-        copy_tree("IDE_Configs/vscode", ".vscode")
+        shutil.copytree("IDE_Configs/vscode", ".vscode")
     if not os.path.exists(".idea"):
-        copy_tree("IDE_Configs/clion", ".idea")
+        shutil.copytree("IDE_Configs/clion", ".idea")
 
 
-def print_tasks_usage(tasks):
-    grouped = {}
+# Bump when the manifest layout changes to discard stale caches
+TASK_MANIFEST_VERSION = 1
+
+
+def describe_task(stem: str):
+    try:
+        module = importlib.import_module(stem)
+        argparser = module.argparser()
+    except:
+        return None
+    return {
+        "group": getattr(argparser, "group", "Ungrouped"),
+        "usage": argparser.format_usage().strip().removeprefix("usage: "),
+        "description": argparser.description,
+    }
+
+
+def load_task_manifest(tasks: dict) -> dict:
+    """Describe every task without importing it, unless its file changed since
+    the manifest was last written."""
+    manifest_path = util.get_cache_dir() / "task-manifest.json"
+    cached = util.read_json_cache(manifest_path, {})
+    if cached.get("version") != TASK_MANIFEST_VERSION:
+        cached = {}
+    cached_tasks = cached.get("tasks", {})
+
+    manifest = {}
+    persisted = {}
     for name, stem in tasks.items():
-        try:
-            module = importlib.import_module(stem)
-            argparser = module.argparser()
-        except:
-            argparser = argparse.ArgumentParser(
-                prog=name, description="FAILED TO LOAD MODULE"
+        task_file = TASKS_DIR / f"{stem}.py"
+        stat = task_file.stat()
+        entry = cached_tasks.get(name)
+        digest = None
+        current = (stat.st_mtime_ns, stat.st_size)
+        if entry and (entry["mtime"], entry["size"]) != current:
+            # touched (e.g. by a checkout), but only re-import if the contents differ
+            digest = util.file_hash(task_file)
+            entry = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+            if entry["hash"] != digest:
+                entry = None
+
+        if entry is None:
+            info = describe_task(stem)
+            if info is None:
+                # never persist failures, they're usually a missing dependency
+                manifest[name] = {
+                    "group": "Ungrouped",
+                    "usage": f"{name} [-h]",
+                    "description": "FAILED TO LOAD MODULE",
+                }
+                continue
+            entry = dict(
+                info,
+                mtime=stat.st_mtime_ns,
+                size=stat.st_size,
+                hash=digest or util.file_hash(task_file),
             )
-        try:
-            group = argparser.group
-        except AttributeError:
-            group = "Ungrouped"
-        grouped[group] = grouped.get(group, []) + [argparser]
 
-    for group, argparsers in sorted(grouped.items()):
+        manifest[name] = entry
+        persisted[name] = entry
+
+    if persisted != cached_tasks:
+        util.write_json_cache(
+            manifest_path, {"version": TASK_MANIFEST_VERSION, "tasks": persisted}
+        )
+    return manifest
+
+
+def print_tasks_usage(tasks):
+    grouped = {}
+    for name, entry in load_task_manifest(tasks).items():
+        grouped.setdefault(entry["group"], []).append(entry)
+
+    for group, entries in sorted(grouped.items()):
         print(textwrap.indent(group + ":", " " * 2))
-        for argparser in argparsers:
-            # get our argparsers (lazy import)
-            usage: str = argparser.format_usage().strip().removeprefix("usage: ")
-            # usage = f"{PROG_NAME} " + usage
+        for entry in entries:
+            print(textwrap.indent(entry["usage"], " " * 4))
+            if entry["description"]:
+                print(textwrap.indent(entry["description"], " " * 6))
+
 
-            print(textwrap.indent(usage, " " * 4))
-            if argparser.description:
-                print(textwrap.indent(argparser.description, " " * 6))
+def forward_to_server(argv):
+    import dbtserver
+
+    return dbtserver.forward(argv)
 
 
 def print_help(argparser: argparse.ArgumentParser, tasks: dict):
@@ -98,7 +213,8 @@ def main() -> int:
     task_files = TASKS_DIR.glob("task-*.py")
 
     # copy vscode config to .vscode if it doesn't exist
-    setup_ide_configs()
+    with profiler.phase("setup_ide_configs"):
+        setup_ide_configs()
 
     tasks = {}
     for task_file in task_files:
@@ -114,8 +230,26 @@ def main() -> int:
         if sys.argv[1:]:
             sys.argv = sys.argv[1:]
 
+        # Hand over to a resident `dbt server` if one is running
+        if not os.environ.get("DBT_NO_SERVER") and not os.environ.get(
+            "DBT_DISPATCH_ONLY"
+        ):
+            with profiler.phase("server"):
+                retcode = forward_to_server(sys.argv)
+            if retcode is not None:
+                sys.exit(retcode)
+
         # Call out to our task. (lazy import)
-        retcode = importlib.import_module(tasks[task_name]).main()
+        with profiler.phase("task import"):
+            module = importlib.import_module(tasks[task_name])
+
+        # used by `dbt benchmark` to time dispatch without running the task
+        if os.environ.get("DBT_DISPATCH_ONLY"):
+            module.argparser()
+            return 0
+
+        with profiler.phase("task main"):
+            retcode = pipeline.dispatch(module, sys.argv, tasks)
         sys.exit(retcode)
 
     args = parser.parse_args()
@@ -132,9 +266,27 @@ def main() -> int:
         print_tasks_usage(tasks)
 
 
+def write_profile():
+    profile = profiler.active()
+    path = Path(PROFILE_PATH) if PROFILE_PATH else util.get_cache_dir() / "profile.json"
+    profile.write(path, sys.argv)
+    util.note(f"Profile written to {path}")
+
+
 if __name__ == "__main__":
     try:
+        if (
+            os.name == "posix"
+            and os.environ.get(ENV_SNAPSHOT_REQUEST)
+            and not os.environ.get(ENV_SNAPSHOT_APPLIED)
+        ):
+            with profiler.phase("setup"):
+                setup()
+            use_toolchain_python()
         retcode = main()
         sys.exit(retcode)
     except KeyboardInterrupt:
         sys.exit(130)
+    finally:
+        if profiler.active():
+            write_profile()
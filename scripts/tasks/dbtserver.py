@@ -0,0 +1,292 @@
+import hashlib
+import importlib
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+from pathlib import Path
+from stat import S_ISSOCK
+import pipeline
+import util
+
+# Resident dbt server. `dbt server` keeps the interpreter and task modules warm and
+# forks a child per request; dbt.py forwards invocations to it over a Unix socket,
+# handing over its stdin/stdout/stderr so the task talks to the caller directly.
+
+# server -> client replies: a tag byte followed by a 32-bit int
+REPLY = struct.Struct("!ci")
+REPLY_PID = b"P"
+REPLY_EXIT = b"X"
+REPLY_LOCAL = b"L"  # the client should run the task itself
+
+HEADER = struct.Struct("!I")
+
+# struct ucred, as returned for SO_PEERCRED: pid, uid, gid
+PEERCRED = struct.Struct("3i")
+
+# AF_UNIX paths are limited to ~100 bytes on most platforms
+MAX_SOCKET_PATH = 100
+
+
+def is_supported() -> bool:
+    return (
+        hasattr(socket, "AF_UNIX")
+        and hasattr(socket, "send_fds")
+        and hasattr(os, "fork")
+    )
+
+
+def socket_path() -> Path:
+    path = util.get_cache_dir() / "dbt.sock"
+    if len(str(path)) > MAX_SOCKET_PATH:
+        import tempfile
+
+        root_hash = hashlib.sha1(str(util.get_git_root()).encode()).hexdigest()[:12]
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+        path = Path(runtime_dir) / f"dbt-{os.getuid()}-{root_hash}.sock"
+    return path
+
+
+def _send_message(sock: socket.socket, message: dict, fds=()) -> None:
+    body = json.dumps(message).encode()
+    header = HEADER.pack(len(body))
+    if fds:
+        socket.send_fds(sock, [header], list(fds))
+    else:
+        sock.sendall(header)
+    sock.sendall(body)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("dbt server connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def _recv_message(sock: socket.socket):
+    header, fds, _, _ = socket.recv_fds(sock, HEADER.size, 3)
+    if len(header) < HEADER.size:
+        header += _recv_exact(sock, HEADER.size - len(header))
+    (length,) = HEADER.unpack(header)
+    return json.loads(_recv_exact(sock, length)), fds
+
+
+def _is_own_server(sock: socket.socket, path: Path) -> bool:
+    # the socket may live in the shared temp directory, and the client hands over
+    # its environment and terminal, so only talk to a server run by this user
+    if hasattr(socket, "SO_PEERCRED"):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+        _, uid, _ = PEERCRED.unpack(creds)
+        return uid == os.getuid()
+    stat = path.lstat()
+    return S_ISSOCK(stat.st_mode) and stat.st_uid == os.getuid()
+
+
+def _connect(path: Path):
+    if not is_supported() or not path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+        if _is_own_server(sock, path):
+            return sock
+        util.note(f"dbt server: ignoring {path}, it belongs to another user")
+    except OSError:
+        # stale socket from a server that went away
+        pass
+    sock.close()
+    return None
+
+
+## Client
+
+
+def forward(argv) -> int | None:
+    """Run argv on the resident server. Returns None when the caller should run
+    the task in-process instead (no server, or the server declined)."""
+    sock = _connect(socket_path())
+    if sock is None:
+        return None
+
+    with sock:
+        request = {"argv": list(argv), "cwd": os.getcwd(), "env": dict(os.environ)}
+        _send_message(sock, request, fds=(0, 1, 2))
+        pid = None
+        try:
+            while True:
+                tag, value = REPLY.unpack(_recv_exact(sock, REPLY.size))
+                if tag == REPLY_PID:
+                    pid = value
+                elif tag == REPLY_EXIT:
+                    return value
+                else:
+                    return None
+        except KeyboardInterrupt:
+            if pid:
+                os.kill(pid, signal.SIGINT)
+            return 130
+        except ConnectionError:
+            # the server died before the task started, so it's safe to retry locally
+            return None if pid is None else 1
+
+
+def stop() -> bool:
+    sock = _connect(socket_path())
+    if sock is None:
+        return False
+    with sock:
+        _send_message(sock, {"stop": True})
+    return True
+
+
+## Server
+
+
+def _source_snapshot(tasks_dir: Path) -> dict:
+    return {path.name: path.stat().st_mtime_ns for path in tasks_dir.glob("*.py")}
+
+
+class Server:
+    def __init__(self, tasks_dir: Path, verbose: bool = False):
+        self.tasks_dir = tasks_dir
+        self.verbose = verbose
+        self.modules = {}
+        self.tasks = {}
+        self.snapshot = _source_snapshot(tasks_dir)
+        self.restart = False
+        self.listener = None
+
+    def preload(self) -> None:
+        util.get_context()
+        for task_file in sorted(self.tasks_dir.glob("task-*.py")):
+            name = task_file.stem.removeprefix("task-")
+            self.tasks[name] = task_file.stem
+            try:
+                module = importlib.import_module(task_file.stem)
+                argparser = module.argparser()
+            except Exception as e:
+                if self.verbose:
+                    util.note(f"server: not serving {name}: {e}")
+                continue
+            if not getattr(argparser, "serve", True):
+                continue
+            # let tasks front-load their own expensive lookups
+            prewarm = getattr(module, "prewarm", None)
+            if prewarm:
+                prewarm()
+            self.modules[name] = module
+
+    def stale(self) -> bool:
+        return _source_snapshot(self.tasks_dir) != self.snapshot
+
+    def handle(self, conn: socket.socket) -> bool:
+        """Serve one connection. Returns False when the server should exit."""
+        request, fds = _recv_message(conn)
+        if request.get("stop"):
+            return False
+
+        argv = request["argv"]
+        module = self.modules.get(argv[0]) if argv else None
+        stale = self.stale()
+        if module is None or stale:
+            conn.sendall(REPLY.pack(REPLY_LOCAL, 0))
+            for fd in fds:
+                os.close(fd)
+            # restart to pick up edited task modules before the next request
+            self.restart = stale
+            return not stale
+
+        if self.verbose:
+            util.note(f"server: {' '.join(argv)}")
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(conn, fds, request, module)
+        for fd in fds:
+            os.close(fd)
+        conn.sendall(REPLY.pack(REPLY_PID, pid))
+        return True
+
+    def _run_child(self, conn, fds, request, module):
+        code = 1
+        try:
+            self.listener.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+            sys.stdin = open(0, "r", closefd=False)
+            sys.stdout = open(1, "w", closefd=False)
+            # line buffered like Python's own stderr, so output comes out in the
+            # same order as when the task runs in-process
+            sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            sys.argv = request["argv"]
+            try:
+                code = pipeline.dispatch(module, sys.argv, self.tasks) or 0
+            except SystemExit as e:
+                code = (
+                    e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+                )
+            except KeyboardInterrupt:
+                code = 130
+        finally:
+            try:
+                # os._exit skips atexit, so reap this child's worker pool here
+                util.shutdown_pool(terminate=True)
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(REPLY.pack(REPLY_EXIT, code))
+            finally:
+                os._exit(code & 0xFF)
+
+    def serve_forever(
+        self, path: Path, restart_argv, idle_timeout: float = None
+    ) -> int:
+        path.unlink(missing_ok=True)
+        listener = self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            listener.bind(str(path))
+        finally:
+            os.umask(old_umask)
+        listener.listen()
+        listener.settimeout(idle_timeout)
+        # children are never waited on explicitly
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        try:
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    util.note("server: idle timeout reached, exiting")
+                    break
+                with conn:
+                    conn.settimeout(None)
+                    try:
+                        if not self.handle(conn):
+                            break
+                    except ConnectionError:
+                        # the client hung up before sending its request
+                        continue
+        finally:
+            listener.close()
+            path.unlink(missing_ok=True)
+
+        if self.restart:
+            util.note("server: task sources changed, restarting")
+            os.execv(restart_argv[0], restart_argv)
+        return 0
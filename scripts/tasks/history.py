@@ -0,0 +1,123 @@
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import time
+from pathlib import Path
+import util
+
+# Local record of every task run, reported by `dbt stats`. It is kept in the common
+# git directory (.git/dbt/history.sqlite3), shared by all worktrees and out of reach
+# of `dbt nuke`, which wipes build/. Set DBT_NO_HISTORY to disable recording.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    task TEXT NOT NULL,
+    argv TEXT NOT NULL,
+    started REAL NOT NULL,
+    wall REAL NOT NULL,
+    exit_code INTEGER NOT NULL,
+    revision TEXT,
+    cores INTEGER,
+    host TEXT
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    wall REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_task ON runs(task, started);
+"""
+
+# sub-phase timings of the run currently in progress
+_phases = []
+
+
+def database_path() -> Path:
+    dirs = util.get_git_dirs()
+    if dirs is None:
+        return util.get_cache_dir() / "history.sqlite3"
+    directory = dirs[1] / "dbt"
+    directory.mkdir(exist_ok=True)
+    path = directory / "history.sqlite3"
+    # carry over a history recorded under build/ by earlier versions
+    previous = util.get_cache_dir() / "history.sqlite3"
+    if previous.exists() and not path.exists():
+        try:
+            os.replace(previous, path)
+        except OSError:
+            pass
+    return path
+
+
+def connect() -> sqlite3.Connection:
+    db = sqlite3.connect(database_path(), timeout=10)
+    db.executescript(SCHEMA)
+    return db
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
+
+
+def _exit_code(e: BaseException) -> int:
+    if isinstance(e, SystemExit):
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        return 1
+    if isinstance(e, KeyboardInterrupt):
+        return 130
+    return 1
+
+
+def _store(argv, started: float, wall: float, exit_code: int) -> None:
+    try:
+        with contextlib.closing(connect()) as db, db:
+            cursor = db.execute(
+                "INSERT INTO runs (task, argv, started, wall, exit_code, revision, cores, host)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    argv[0],
+                    json.dumps(list(argv[1:])),
+                    started,
+                    wall,
+                    exit_code,
+                    util.get_git_revision(),
+                    os.cpu_count(),
+                    socket.gethostname(),
+                ),
+            )
+            db.executemany(
+                "INSERT INTO phases (run_id, name, wall) VALUES (?, ?, ?)",
+                [(cursor.lastrowid, name, wall) for name, wall in _phases],
+            )
+    except (sqlite3.Error, OSError) as e:
+        # history is best-effort, it must never fail the task itself
+        util.note(f"dbt: could not record run history: {e}")
+
+
+def record(func, argv):
+    """Call func() and record the run of argv (task name first)."""
+    if os.environ.get("DBT_NO_HISTORY"):
+        return func()
+
+    _phases.clear()
+    started = time.time()
+    start = time.perf_counter()
+    exit_code = 1
+    try:
+        result = func()
+        exit_code = result if isinstance(result, int) else 0
+        return result
+    except BaseException as e:
+        exit_code = _exit_code(e)
+        raise
+    finally:
+        _store(argv, started, time.perf_counter() - start, exit_code)
@@ -0,0 +1,130 @@
+import contextlib
+import os
+import select
+import shutil
+import tempfile
+
+# GNU make jobserver protocol, so dbt's parallel work shares one pool of job slots
+# with make, ninja (1.13+) and other dbt tasks instead of each assuming every core.
+#
+# A jobserver is advertised through MAKEFLAGS as either
+#   --jobserver-auth=fifo:PATH  (make 4.4+) or
+#   --jobserver-auth=R,W / --jobserver-fds=R,W  (inherited pipe descriptors).
+# Every process owns one implicit slot; each additional concurrent job needs a token
+# (a byte) read from the jobserver, which is written back once the job is done.
+
+
+def _parse_makeflags(makeflags: str):
+    auth = None
+    for flag in makeflags.split():
+        for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+            if flag.startswith(prefix):
+                auth = flag[len(prefix) :]  # the last one wins, as in make
+    if not auth:
+        return None
+    if auth.startswith("fifo:"):
+        return ("fifo", auth[len("fifo:") :])
+    try:
+        read_fd, write_fd = (int(fd) for fd in auth.split(","))
+    except ValueError:
+        return None
+    return ("fds", read_fd, write_fd)
+
+
+class Client:
+    def __init__(self, read_fd: int, write_fd: int, owned=(), nonblocking=True):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.owned = owned
+        self.nonblocking = nonblocking
+
+    def try_acquire(self):
+        """Take a token if one is free right now. Returns the token or None."""
+        if not self.nonblocking:
+            # shared blocking descriptor: only read once select says a byte is there
+            # (another client can still win the race, leaving us waiting for the next)
+            readable, _, _ = select.select([self.read_fd], [], [], 0)
+            if not readable:
+                return None
+        try:
+            token = os.read(self.read_fd, 1)
+        except (BlockingIOError, InterruptedError):
+            return None
+        return token or None
+
+    def release(self, token: bytes) -> None:
+        os.write(self.write_fd, token)
+
+    def close(self) -> None:
+        for fd in self.owned:
+            os.close(fd)
+        self.owned = ()
+
+
+def _is_open(fd: int) -> bool:
+    try:
+        os.fstat(fd)
+        return True
+    except OSError:
+        return False
+
+
+def client():
+    """Connect to the jobserver advertised in MAKEFLAGS, if any."""
+    auth = _parse_makeflags(os.environ.get("MAKEFLAGS", ""))
+    if auth is None or not hasattr(os, "O_NONBLOCK"):
+        return None
+
+    if auth[0] == "fifo":
+        try:
+            read_fd = os.open(auth[1], os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return None
+        write_fd = os.open(auth[1], os.O_WRONLY)
+        return Client(read_fd, write_fd, owned=(read_fd, write_fd))
+
+    _, read_fd, write_fd = auth
+    # make only passes the descriptors to commands it knows are recursive
+    if not (_is_open(read_fd) and _is_open(write_fd)):
+        return None
+    try:
+        # a private open file description, so O_NONBLOCK doesn't leak to make
+        private = os.open(f"/proc/self/fd/{read_fd}", os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return Client(read_fd, write_fd, nonblocking=False)
+    return Client(private, write_fd, owned=(private,))
+
+
+def is_advertised() -> bool:
+    return _parse_makeflags(os.environ.get("MAKEFLAGS", "")) is not None
+
+
+@contextlib.contextmanager
+def serve(jobs: int):
+    """Run the body with a fifo jobserver of `jobs` slots advertised in MAKEFLAGS,
+    unless one is already advertised or the platform has no fifos."""
+    if is_advertised() or not hasattr(os, "mkfifo") or jobs < 2:
+        yield
+        return
+
+    directory = tempfile.mkdtemp(prefix="dbt-jobserver-")
+    path = os.path.join(directory, "fifo")
+    os.mkfifo(path, 0o600)
+    # keep a reader open so writes never fail while no client is connected
+    read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    write_fd = os.open(path, os.O_WRONLY)
+    os.write(write_fd, b"+" * (jobs - 1))
+
+    saved = os.environ.get("MAKEFLAGS")
+    flags = f"-j{jobs} --jobserver-auth=fifo:{path}"
+    os.environ["MAKEFLAGS"] = f"{flags} {saved}" if saved else flags
+    try:
+        yield
+    finally:
+        if saved is None:
+            os.environ.pop("MAKEFLAGS", None)
+        else:
+            os.environ["MAKEFLAGS"] = saved
+        os.close(read_fd)
+        os.close(write_fd)
+        shutil.rmtree(directory, ignore_errors=True)
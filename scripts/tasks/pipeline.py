@@ -0,0 +1,288 @@
+import contextlib
+import importlib
+import io
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import history
+import jobserver
+import util
+
+# Multi-task pipelines: `dbt build release test loadfw release`.
+#
+# A task name on the command line starts a new step, unless the current task takes
+# it as one of its own arguments (`dbt build debug` builds the Debug config); `+`
+# always starts a new step (`dbt format -c + test`). Tasks may define
+#   prerequisites(argv) -> list of argvs to run first (unless already run earlier)
+#   resources(argv) -> (reads, writes) sets of resource names
+#   inputs_outputs(argv) -> (inputs, outputs) globs, or None to always run; the task
+#     is skipped while it is up to date (see util.is_up_to_date)
+# Steps that don't touch the same resources run concurrently; a task without
+# resources() is treated as needing the whole machine to itself. Tasks that consume
+# the rest of the command line (e.g. shell) set `parser.pipeline = False`.
+
+# set for the child processes running concurrent steps
+STEP_ENV = "DBT_PIPELINE_STEP"
+
+# explicitly starts a new step, whatever the previous task accepts
+SEPARATOR = "+"
+
+
+class Step:
+    def __init__(self, argv, module, required_by=None):
+        self.argv = list(argv)
+        self.name = argv[0]
+        self.module = module
+        self.deps = set()
+        self.auto = required_by is not None
+        self.required_by = required_by
+        self.code = None
+
+        resources = getattr(module, "resources", None)
+        if resources:
+            self.reads, self.writes = (set(r) for r in resources(self.argv))
+            self.exclusive = False
+        else:
+            self.reads, self.writes = set(), set()
+            self.exclusive = True
+
+    def __str__(self):
+        return " ".join(self.argv)
+
+    def conflicts(self, other) -> bool:
+        if self.exclusive or other.exclusive:
+            return True
+        return bool(
+            self.writes & (other.reads | other.writes)
+            or other.writes & (self.reads | self.writes)
+        )
+
+    def satisfies(self, argv) -> bool:
+        # a bare prerequisite (no arguments) is met by any run of that task
+        return self.argv == list(argv) or (len(argv) == 1 and self.name == argv[0])
+
+
+class Pipeline:
+    def __init__(self, tasks: dict):
+        self.tasks = tasks
+        self.modules = {}
+        self.steps = []
+
+    def module(self, name: str):
+        if name not in self.modules:
+            self.modules[name] = importlib.import_module(self.tasks[name])
+        return self.modules[name]
+
+    def accepts_pipeline(self, name: str) -> bool:
+        return getattr(self.module(name).argparser(), "pipeline", True)
+
+    def consumes(self, segment, arg: str) -> bool:
+        """Whether the task in segment would take arg as one of its own arguments."""
+        parser = self.module(segment[0]).argparser()
+
+        def reject(message):
+            raise ValueError(message)
+
+        parser.error = reject
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, extras = parser.parse_known_args(segment[1:] + [arg])
+        except (ValueError, SystemExit):
+            # an invalid choice (or -h): not an argument of this task
+            return False
+        return extras[-1:] != [arg]
+
+    def split(self, argv):
+        segments = [[argv[0]]]
+        for arg in argv[1:]:
+            current = segments[-1]
+            if not current:
+                if arg != SEPARATOR:
+                    current.append(arg)
+            elif current[0] not in self.tasks or not self.accepts_pipeline(current[0]):
+                current.append(arg)
+            elif arg == SEPARATOR:
+                segments.append([])
+            elif arg in self.tasks and not self.consumes(current, arg):
+                segments.append([arg])
+            else:
+                current.append(arg)
+        return [segment for segment in segments if segment]
+
+    def add(self, argv, required_by=None) -> Step:
+        for step in self.steps:
+            if step.satisfies(argv):
+                return step
+
+        module = self.module(argv[0])
+        prerequisites = getattr(module, "prerequisites", None)
+        deps = set()
+        if prerequisites:
+            for prerequisite in prerequisites(list(argv)):
+                deps.add(self.add(prerequisite, required_by=argv[0]))
+
+        step = Step(argv, module, required_by)
+        step.deps = deps | {other for other in self.steps if step.conflicts(other)}
+        self.steps.append(step)
+        return step
+
+    def run(self) -> int:
+        # concurrent steps share one set of job slots with each other's parallel
+        # work (and with ninja), rather than each assuming every core is theirs
+        with jobserver.serve(multiprocessing.cpu_count()):
+            return self._run()
+
+    def _run(self) -> int:
+        pending = list(self.steps)
+        running = {}
+        finished = queue.Queue()
+        failure = 0
+        started = time.perf_counter()
+        tokens = jobserver.client()
+
+        try:
+            while pending or running:
+                ready = (
+                    []
+                    if failure
+                    else [
+                        step
+                        for step in pending
+                        if all(dep.code == 0 for dep in step.deps)
+                    ]
+                )
+                # a failed prerequisite means its dependents can never run
+                pending = [
+                    step
+                    for step in pending
+                    if not any(dep.code not in (None, 0) for dep in step.deps)
+                ]
+
+                if len(ready) == 1 and not running:
+                    # nothing to overlap with, so skip the extra interpreter
+                    step = ready[0]
+                    pending.remove(step)
+                    self._announce(step)
+                    step.code = run_in_process(step.module, step.argv)
+                    failure = failure or step.code
+                    continue
+
+                waiting = False
+                for step in ready:
+                    # the first running step uses our own slot, the rest need a token
+                    token = None
+                    if running and tokens:
+                        token = tokens.try_acquire()
+                        if token is None:
+                            waiting = True
+                            break
+                    pending.remove(step)
+                    self._announce(step)
+                    running[step] = (self._spawn(step, finished), token)
+
+                if not running:
+                    break
+                try:
+                    step, code = finished.get(timeout=0.1 if waiting else None)
+                except queue.Empty:
+                    continue
+                _, token = running.pop(step)
+                if token:
+                    tokens.release(token)
+                step.code = code
+                failure = failure or code
+        finally:
+            for _, token in running.values():
+                if token:
+                    tokens.release(token)
+            if tokens:
+                tokens.close()
+
+        elapsed = time.perf_counter() - started
+        for step in self.steps:
+            status = {None: "skipped", 0: "ok"}.get(step.code, f"failed ({step.code})")
+            util.note(f"pipeline: {step}: {status}")
+        util.note(f"pipeline: finished in {elapsed:.1f}s")
+        return failure
+
+    def _announce(self, step):
+        reason = f" (required by {step.required_by})" if step.auto else ""
+        util.note(f"==> {step}{reason}")
+
+    def _spawn(self, step, finished):
+        root = util.get_git_root()
+        process = subprocess.Popen(
+            [sys.executable, str(root / "dbt.py")] + step.argv,
+            cwd=root,
+            env=dict(os.environ, **{STEP_ENV: "1"}),
+        )
+
+        def wait():
+            finished.put((step, process.wait()))
+
+        threading.Thread(target=wait, daemon=True).start()
+        return process
+
+
+def run_task(module, argv):
+    declared = getattr(module, "inputs_outputs", None)
+    io = declared(list(argv)) if declared else None
+    if io is None:
+        return history.record(module.main, argv)
+
+    inputs, outputs = io
+    if util.is_up_to_date(argv[0], argv, inputs, outputs):
+        util.note(f"{argv[0]}: up to date")
+        return 0
+    result = history.record(module.main, argv)
+    if not result:
+        util.record_up_to_date(argv[0], argv, inputs, outputs)
+    return result
+
+
+def run_in_process(module, argv) -> int:
+    saved_argv, saved_cwd = sys.argv, os.getcwd()
+    sys.argv = list(argv)
+    try:
+        return run_task(module, argv) or 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        return 1
+    finally:
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+
+
+def is_pipeline(argv, tasks: dict, module) -> bool:
+    if os.environ.get(STEP_ENV):
+        return False
+    if not getattr(module.argparser(), "pipeline", True):
+        return False
+    return hasattr(module, "prerequisites") or any(
+        arg in tasks or arg == SEPARATOR for arg in argv[1:]
+    )
+
+
+def dispatch(module, argv, tasks: dict):
+    """Run the task in argv (already imported as module), expanding it into a
+    pipeline when it names further tasks or has prerequisites."""
+    if not is_pipeline(argv, tasks, module):
+        return run_task(module, argv)
+
+    pipeline = Pipeline(tasks)
+    pipeline.modules[argv[0]] = module
+    segments = pipeline.split(argv)
+    for segment in segments:
+        if segment[0] not in tasks:
+            print(f"Error: `{segment[0]}` is not a task", file=sys.stderr)
+            return 1
+    for segment in segments:
+        pipeline.add(segment)
+    if len(pipeline.steps) == 1:
+        return run_task(module, argv)
+    return pipeline.run()
@@ -0,0 +1,112 @@
+import contextlib
+import importlib.abc
+import json
+import sys
+import time
+from pathlib import Path
+
+# Startup/dispatch profiler behind `dbt --profile`. Kept dependency-free so it can
+# be installed before util and the task modules are imported.
+
+_active = None
+
+
+class _TimedLoader:
+    """Wraps a module loader so executing the module is timed."""
+
+    def __init__(self, loader, profile, name):
+        self._loader = loader
+        self._profile = profile
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        with self._profile.time_import(self._name):
+            self._loader.exec_module(module)
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    def __init__(self, profile):
+        self._profile = profile
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, self._profile, fullname)
+                return spec
+        return None
+
+
+class Profile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.imports = {}
+        self._import_stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    @contextlib.contextmanager
+    def time_import(self, name: str):
+        # children's time is subtracted from the parent's to get self time
+        self._import_stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self._import_stack.pop()
+            if self._import_stack:
+                self._import_stack[-1] += elapsed
+            self.imports[name] = {
+                "module": name,
+                "cumulative": elapsed,
+                "self": elapsed - children,
+            }
+
+    def report(self, argv) -> dict:
+        return {
+            "argv": list(argv),
+            "total": time.perf_counter() - self.started,
+            "phases": self.phases,
+            "imports": sorted(
+                self.imports.values(), key=lambda i: i["cumulative"], reverse=True
+            ),
+        }
+
+    def write(self, path: Path, argv) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(argv), f, indent=2)
+
+
+def install() -> Profile:
+    global _active
+    _active = Profile()
+    sys.meta_path.insert(0, _ImportTimer(_active))
+    return _active
+
+
+def active():
+    return _active
+
+
+def phase(name: str):
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.phase(name)
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import util
+
+
+def argparser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Measure cold and warm dispatch latency of every dbt task",
+    )
+    parser.group = "Development"
+    # takes the rest of the command line, even if it names other tasks
+    parser.pipeline = False
+    parser.add_argument(
+        "-n",
+        "--runs",
+        help="number of warm runs per task",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the results to this JSON file", type=str
+    )
+    parser.add_argument(
+        "tasks",
+        nargs="*",
+        help="tasks to measure (defaults to all of them, plus the help listing)",
+    )
+    return parser
+
+
+def dispatch(task: str, env: dict) -> dict:
+    # --profile gives us the in-process phase breakdown alongside the wall time
+    with tempfile.TemporaryDirectory() as tmp:
+        profile_path = Path(tmp) / "profile.json"
+        command = [sys.executable, "dbt.py", f"--profile={profile_path}"]
+        if task:
+            command.append(task)
+        start = time.perf_counter()
+        subprocess.run(
+            command,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        wall = time.perf_counter() - start
+        profile = util.read_json_cache(profile_path, {})
+
+    return {"wall": wall, "phases": profile.get("phases", {})}
+
+
+def measure(task: str, runs: int) -> dict:
+    env = dict(os.environ, DBT_DISPATCH_ONLY="1")
+
+    # cold: no bytecode caches and no task manifest
+    with tempfile.TemporaryDirectory() as pycache:
+        util.get_cache_dir().joinpath("task-manifest.json").unlink(missing_ok=True)
+        cold = dispatch(task, dict(env, PYTHONPYCACHEPREFIX=pycache))
+
+    dispatch(task, env)  # prime the caches
+    warm = [dispatch(task, env) for _ in range(runs)]
+    walls = [run["wall"] for run in warm]
+
+    return {
+        "task": task or "<help>",
+        "cold": cold["wall"],
+        "warm_median": statistics.median(walls),
+        "warm_min": min(walls),
+        "cold_phases": cold["phases"],
+        "warm_phases": min(warm, key=lambda run: run["wall"])["phases"],
+    }
+
+
+def main() -> int:
+    args = argparser().parse_args()
+    os.chdir(util.get_git_root())
+
+    tasks = args.tasks or [""] + sorted(
+        path.stem.removeprefix("task-")
+        for path in Path("scripts/tasks").glob("task-*.py")
+    )
+
+    results = []
+    print(f"{'task':<16} {'cold':>9} {'warm':>9} {'import':>9}")
+    for task in tasks:
+        result = measure(task, max(args.runs, 1))
+        results.append(result)
+        task_import = result["warm_phases"].get("task import", 0.0)
+        print(
+            f"{result['task']:<16} {result['cold'] * 1000:>7.1f}ms "
+            f"{result['warm_median'] * 1000:>7.1f}ms {task_import * 1000:>7.1f}ms"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,7 @@ import argparse
 import importlib
 import subprocess
 import sys
+import history
 import util
 import os
 
@@ -56,6 +57,18 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+def prerequisites(argv) -> list:
+    (args, _) = argparser().parse_known_args(argv[1:])
+    # tagged builds (re)configure themselves with the tagging arguments
+    if args.tag_metadata or util.is_configured(util.get_context().build_dir):
+        return []
+    return [["configure"]]
+
+
+def resources(argv):
+    return {"sources"}, {"build"}
+
+
 def main() -> int:
     (args, unknown_args) = argparser().parse_known_args()
 
@@ -66,14 +79,16 @@ def main() -> int:
         if args.type:
             configure_args += ["-t", args.type]
         # configure with tagging
-        result = importlib.import_module("task-configure").main(
-            ["-m"] + configure_args + unknown_args
-        )
+        with history.phase("configure"):
+            result = importlib.import_module("task-configure").main(
+                ["-m"] + configure_args + unknown_args
+            )
         if result != 0:
             return result
 
-    elif not os.path.exists("build"):
-        result = importlib.import_module("task-configure").main()
+    elif not util.is_configured():
+        with history.phase("configure"):
+            result = importlib.import_module("task-configure").main()
         if result != 0:
             return result
 
@@ -101,7 +116,8 @@ def main() -> int:
     if args.no_status:
         build_args += ["--", "--quiet"]  # pass quiet directly to ninja
 
-    result = subprocess.run(["cmake"] + build_args, env=os.environ)
+    with history.phase("build"):
+        result = subprocess.run([util.get_tool("cmake")] + build_args, env=os.environ)
     return result.returncode
 
 
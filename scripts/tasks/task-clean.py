@@ -15,10 +15,14 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+def resources(argv):
+    return set(), {"build"}
+
+
 def main() -> int:
     os.chdir(util.get_git_root())
 
-    if not os.path.exists("build"):
+    if not util.is_configured():
         print("Already clean!")
         exit()
 
@@ -28,7 +32,7 @@ def main() -> int:
         "--target",
         "clean",
     ]
-    result = subprocess.run(["cmake"] + cmake_args, env=os.environ)
+    result = subprocess.run([util.get_tool("cmake")] + cmake_args, env=os.environ)
     return result.returncode
 
 
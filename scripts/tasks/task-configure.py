@@ -44,12 +44,30 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+def inputs_outputs(argv):
+    (args, _) = argparser().parse_known_args(argv[1:])
+    if args.force:
+        return None
+    inputs = [
+        "CMakeLists.txt",
+        "src/**/CMakeLists.txt",
+        "lib/CMakeLists.txt",
+        "scripts/cmake/*.cmake",
+        "toolchain/REQUIRED_VERSION",
+    ]
+    return inputs, ["build/CMakeCache.txt", "build/build.ninja"]
+
+
+def resources(argv):
+    return set(), {"build"}
+
+
 def main(argv: Sequence[str] = None) -> int:
     (args, unknown_args) = argparser().parse_known_args(argv)
 
-    project_root = util.get_git_root()
-    build_dir = project_root.absolute() / "build"
-    source_dir = project_root.absolute()
+    context = util.get_context()
+    build_dir = context.build_dir
+    source_dir = context.root.absolute()
 
     if args.force:
         result = importlib.import_module("task-nuke").main()
@@ -77,7 +95,7 @@ def main(argv: Sequence[str] = None) -> int:
             f"-DRELEASE_TYPE:STRING={args.type.lower()}",
         ]
 
-    result = subprocess.run(["cmake"] + configure_args, env=os.environ)
+    result = subprocess.run([util.get_tool("cmake")] + configure_args, env=os.environ)
     return result.returncode
 
 
@@ -1,6 +1,5 @@
 import argparse
 from pathlib import Path
-import shutil
 import util
 
 TARGET_DEVICE = "R7S721020"
@@ -9,23 +8,13 @@ OPENOCD_TARGET_DEVICE_SWD = "scripts/debug/openocd/deluge-swj-swd.cfg"
 OPENOCD_TARGET_DEVICE_JTAG = "scripts/debug/openocd/deluge-swj-jtag.cfg"
 
 
-def find_cmd_with_fallback(cmd, fallback):
-    which_result = shutil.which(cmd)
-    if which_result:
-        return which_result
-    else:
-        return fallback
-
-
 def absolute_path_str(path: str):
     return str(Path(path).absolute())
 
 
 def jlink_gdb(cmd, device: str, endian: str, protocol: str, gdb_port: int):
     if not cmd:
-        cmd = find_cmd_with_fallback(
-            "JLinkGDBServerCL", "C:\\Program Files\\SEGGER\\JLink\\JLinkGDBServerCL"
-        )
+        cmd = util.get_tool("JLinkGDBServerCL")
 
     return [
         cmd,
@@ -44,7 +33,7 @@ def jlink_gdb(cmd, device: str, endian: str, protocol: str, gdb_port: int):
 
 def openocd_gdb(cmd, interface: str, target: str, protocol: str, gdb_port: int):
     if not cmd:
-        cmd = find_cmd_with_fallback("openocd", "openocd")
+        cmd = util.get_tool("openocd")
 
     # if we haven't gotten an interface with a path already, qualify it
     if len(target.split("/")) == 1:
@@ -70,6 +59,8 @@ def argparser() -> argparse.ArgumentParser:
         description="Run a debug server (JLink or OpenOCD)",
     )
     parser.group = "Debugging"
+    # interactive, needs to own the controlling terminal
+    parser.serve = False
     parser.add_argument(
         "-j", "--jlink", action="store_true", help="Use JLinkGDB instead of OpenOCD"
     )
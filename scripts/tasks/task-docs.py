@@ -24,27 +24,45 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+# what doxygen_add_docs() in the top-level CMakeLists.txt reads
+DOC_INPUTS = ["*.md", "docs/**/*", "src/deluge/**/*.[ch]*", "CMakeLists.txt"]
+DOC_OUTPUTS = ["build/html/index.html"]
+
+
+def prerequisites(argv) -> list:
+    return [] if util.is_configured(util.get_context().build_dir) else [["configure"]]
+
+
+def resources(argv):
+    return {"sources"}, {"build"}
+
+
 def main(argv: Sequence[str] = sys.argv) -> int:
     (args, unknown_args) = argparser().parse_known_args(argv)
 
-    project_root = util.get_git_root()
-    build_dir = project_root.absolute() / "build"
-    source_dir = project_root.absolute()
+    build_dir = util.get_context().build_dir
     index_page = build_dir / "html/index.html"
 
-    if not os.path.exists("build"):
+    if not util.is_configured():
         result = importlib.import_module("task-configure").main()
         if result != 0:
             return result
 
-    build_args = []
-    build_args += ["--build", "build"]
-    build_args += ["--target", "doxygen"]
+    rebuild = not args.no_rebuild and not util.is_up_to_date(
+        "docs", [], DOC_INPUTS, DOC_OUTPUTS
+    )
+    if rebuild:
+        build_args = []
+        build_args += ["--build", "build"]
+        build_args += ["--target", "doxygen"]
+
+        result = subprocess.run([util.get_tool("cmake")] + build_args, env=os.environ)
+        if result.returncode != 0:
+            return 1
+        util.record_up_to_date("docs", [], DOC_INPUTS, DOC_OUTPUTS)
 
-    result = subprocess.run(["cmake"] + build_args, env=os.environ)
-    if result.returncode == 0:
-        if webbrowser.open(index_page.absolute()):
-            return 0
+    if webbrowser.open(index_page.absolute()):
+        return 0
     return 1
 
 
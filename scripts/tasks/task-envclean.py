@@ -2,10 +2,8 @@
 
 # Copyright 2023 Kate Whitlock
 import argparse
-from pathlib import Path
 import shutil
-
-VERSION = Path("./toolchain/REQUIRED_VERSION").read_text().strip()
+import util
 
 
 def argparser() -> argparse.ArgumentParser:
@@ -20,11 +18,16 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+def resources(argv):
+    return set(), {"toolchain"}
+
+
 def main() -> int:
     args = argparser().parse_args()
-    toolchains = Path.cwd().glob("toolchain/v*/")
+    context = util.get_context()
+    toolchains = (context.toolchain_path / "toolchain").glob("v*/")
     toolchains_to_delete = [
-        path for path in toolchains if not str(path).endswith(VERSION)
+        path for path in toolchains if path != context.toolchain_dir
     ]
     for toolchain in toolchains_to_delete:
         print(f"Removing {toolchain.name}...")
@@ -2,54 +2,56 @@
 
 # Copyright 2023 Kate Whitlock
 import argparse
-import errno
+import bisect
 import os
-import io
+import multiprocessing
+import re
+import subprocess
+import sys
 from itertools import groupby
 import fnmatch
+import hashlib
+import json
 from pathlib import Path
+from xml.etree import ElementTree
 import util
-from functools import partial
+import watcher as watcher_module
+from functools import cache
 
-EXEC_EXT = ".exe" if os.name == "nt" else ""
 
-DBT_VERSION = util.get_dbt_version()
+TIMINGS_VERSION = 1
+REPORT_VERSION = 2
+SLOWEST_FILES = 10
 
+BATCH_MAX_FILES = 64
+BATCH_MAX_BYTES = 2 * 1024 * 1024
+BATCH_MAX_COMMAND_LENGTH = 24000
 
-def excludes_from_file(ignore_file):
-    excludes = []
-    try:
-        with io.open(ignore_file, "r", encoding="utf-8") as f:
-            for line in f:
-                if line.startswith("#"):
-                    # ignore comments
-                    continue
-                pattern = line.rstrip()
-                if not pattern:
-                    # allow empty lines
-                    continue
-                excludes.append(pattern)
-    except EnvironmentError as e:
-        if e.errno != errno.ENOENT:
-            raise
-    return excludes
-
-
-def exclude(files, excludes):
-    out = []
-    fpaths = [f for f in files]
-    for pattern in excludes:
-        fpaths = [x for x in fpaths if not fnmatch.fnmatch(x, pattern)]
-    return fpaths
+# clang-format diagnostics start with the offending file, e.g.
+#   src/foo.cpp:12:3: error: code should be clang-formatted [-Wclang-format-violations]
+# unified diff hunk header: @@ -old[,count] +new[,count] @@
+HUNK = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+VIOLATION = re.compile(r"^(.+?):\d+:\d+: (?:error|warning): ", re.MULTILINE)
 
 
 def get_clang_format_cmd():
-    tool_path = util.get_git_root() / "toolchain" / f"v{DBT_VERSION}"
-    for path in tool_path.rglob(f"clang-format{EXEC_EXT}"):
-        os.environ["PATH"] += os.pathsep + str(path.parent.absolute())
-        return path
-    # failed to find it in toolchains, falling back to path, then string
-    return util.find_cmd_with_fallback("clang-format")
+    return util.get_tool("clang-format")
+
+
+def get_clang_format_version() -> str:
+    return util.get_tool_version("clang-format")
+
+
+@cache
+def get_style_config(directory: Path) -> str:
+    # every .clang-format above a file may contribute (e.g. InheritParentConfig)
+    parent = directory.parent
+    inherited = get_style_config(parent) if parent != directory else ""
+    config = directory / ".clang-format"
+    if not config.is_file():
+        return inherited
+    return hashlib.sha1((inherited + util.file_hash(config)).encode()).hexdigest()
 
 
 globs = [
@@ -61,11 +63,6 @@ globs = [
 ]
 
 
-def get_header_and_source_files(path, recursive: bool):
-    glob = path.rglob if recursive else path.glob
-    return [file for pattern in globs for file in list(glob(pattern))]
-
-
 def get_valid_header_and_source_files(files):
     return list(
         filter(
@@ -79,21 +76,601 @@ def get_valid_header_and_source_files(files):
     )
 
 
-def format_file(clang_format: str, verbose: bool, check: bool, path: Path):
-    path = str(path.absolute())
+def prewarm():
+    # resolved once per `dbt server` rather than once per request
+    get_clang_format_cmd()
+
+
+def format_command(clang_format: str, check: bool, paths, lines=()):
     command = [clang_format, "--style=file"]
     if check:
         command.append("--dry-run")
         command.append("-Werror")
     else:
         command.append("-i")
-    command.append(path)
-    return util.run(command, verbose, verbose)
+    # only valid with a single file
+    command.extend(f"--lines={first}:{last}" for first, last in lines)
+    command.extend(str(path.absolute()) for path in paths)
+    return command
+
+
+def make_batches(files, jobs: int):
+    """Group files for one clang-format run each. Batches are capped by file count
+    and source bytes, aiming for a few per core so no single batch is left running
+    long after the rest, and by command line length (Windows caps it at 32k)."""
+    sizes = {}
+    for file in files:
+        try:
+            sizes[file] = file.stat().st_size
+        except OSError:
+            sizes[file] = 0
+    slices = jobs * 4
+    max_files = min(BATCH_MAX_FILES, max(1, -(-len(files) // slices)))
+    max_bytes = min(BATCH_MAX_BYTES, max(1, sum(sizes.values()) // slices))
+
+    batches, batch, batch_bytes, batch_length = [], [], 0, 0
+    # biggest first, so the slowest files start early
+    for file in sorted(files, key=lambda file: sizes[file], reverse=True):
+        length = len(str(file.absolute())) + 1
+        if batch and (
+            len(batch) >= max_files
+            or batch_bytes + sizes[file] > max_bytes
+            or batch_length + length > BATCH_MAX_COMMAND_LENGTH
+        ):
+            batches.append(batch)
+            batch, batch_bytes, batch_length = [], 0, 0
+        batch.append(file)
+        batch_bytes += sizes[file]
+        batch_length += length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_results(batch, command) -> list:
+    """Per-file exit codes for one clang-format run over batch."""
+    if command.returncode == 0:
+        return [0] * len(batch)
+    failed = {
+        match.group(1)
+        for match in VIOLATION.finditer(command.stderr.decode(errors="replace"))
+    }
+    paths = [str(file.absolute()) for file in batch]
+    if not failed.intersection(paths):
+        # crashed, timed out or rejected the config: blame the whole batch
+        return [command.returncode or 1] * len(batch)
+    return [1 if path in failed else 0 for path in paths]
+
+
+def changed_lines(base: str = None) -> dict:
+    """Files changed in the working tree relative to base (a git ref, or the index
+    by default), mapped to the line ranges that changed, in working tree lines."""
+    root = util.get_git_root()
+    command = ["git", "diff", "-U0", "--no-color", "--no-ext-diff", "--diff-filter=d"]
+    # explicit prefixes, whatever diff.noprefix/diff.mnemonicPrefix say
+    command += ["--src-prefix=a/", "--dst-prefix=b/"]
+    if base:
+        command.append(base)
+    output = subprocess.run(
+        command, cwd=root, stdout=subprocess.PIPE, check=True
+    ).stdout.decode(errors="surrogateescape")
+
+    changed = {}
+    path = None
+    for line in output.splitlines():
+        if line.startswith("+++ "):
+            name = line[4:]
+            path = (root / name[2:]).absolute() if name.startswith("b/") else None
+            continue
+        match = HUNK.match(line)
+        if match and path is not None:
+            first, count = int(match.group(1)), int(match.group(2) or 1)
+            # count 0 is a pure deletion: nothing left on our side to format
+            if count:
+                changed.setdefault(path, []).append((first, first + count - 1))
+    return changed
+
+
+def staged_blobs() -> dict:
+    """Regular files added or modified in the index, mapped to their staged blob ids."""
+    root = util.get_git_root()
+    command = ["git", "diff", "--cached", "--raw", "-z", "--no-abbrev"]
+    command += ["--no-renames", "--diff-filter=AM"]
+    output = subprocess.run(
+        command, cwd=root, stdout=subprocess.PIPE, check=True
+    ).stdout
+
+    # ":<old mode> <new mode> <old blob> <new blob> <status>\0<path>\0" per file
+    fields = output.split(b"\0")
+    blobs = {}
+    for meta, name in zip(fields[0::2], fields[1::2]):
+        _, mode, _, blob, _ = meta.split()
+        # symlinks and submodules have nothing to format
+        if mode in (b"100644", b"100755"):
+            blobs[(root / os.fsdecode(name)).absolute()] = blob.decode()
+    return blobs
+
+
+def read_blobs(blobs) -> dict:
+    """Contents of git blobs, all read through one `git cat-file --batch` process."""
+    contents = {}
+    with subprocess.Popen(
+        ["git", "cat-file", "--batch"],
+        cwd=util.get_git_root(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    ) as process:
+        # one request at a time, so neither side can fill a pipe and stall
+        for blob in blobs:
+            if blob in contents:
+                continue
+            process.stdin.write(f"{blob}\n".encode())
+            process.stdin.flush()
+            header = process.stdout.readline().split()
+            if len(header) != 3 or header[1] != b"blob":
+                continue  # "<blob> missing"
+            contents[blob] = process.stdout.read(int(header[2]))
+            process.stdout.read(1)  # the newline after every object
+        process.stdin.close()
+    return contents
+
+
+def in_scope(file: Path, files_and_directories, recursive: bool) -> bool:
+    for path in files_and_directories:
+        path = path.absolute()
+        if file == path or file.parent == path or (recursive and path in file.parents):
+            return True
+    return False
+
+
+def format_key(data: bytes, path: Path) -> str:
+    # clang-format picks the language from the extension and the style by directory
+    key = hashlib.sha1(data)
+    style = get_style_config(path.absolute().parent)
+    key.update(f"\0{path.suffix}\0{style}\0{get_clang_format_version()}".encode())
+    return key.hexdigest()
+
+
+def cached_output(outputs, key: str, data: bytes):
+    # blobs are "=" for already formatted input, else "+" and the formatted output
+    value = outputs.get(key)
+    if value is None:
+        return None
+    return data if value[:1] == b"=" else value[1:]
+
+
+def store_output(outputs, key: str, data: bytes, output: bytes) -> None:
+    outputs.put(key, b"=" if output == data else b"+" + output)
+
+
+def lookup_outputs(outputs, files, check: bool):
+    """Resolve files whose content has been formatted before without clang-format.
+    Returns exit codes for those, and (key, content) for the rest."""
+    known, unknown = {}, {}
+    for file in files:
+        try:
+            data = file.read_bytes()
+        except OSError:
+            continue
+        key = format_key(data, file)
+        output = cached_output(outputs, key, data)
+        if output is None:
+            unknown[file] = (key, data)
+        elif output == data:
+            known[file] = 0
+        elif check:
+            print(
+                f"{file.absolute()}: error: code should be clang-formatted (cached)",
+                file=sys.stderr,
+            )
+            known[file] = 1
+        else:
+            file.write_bytes(output)
+            known[file] = 0
+    return known, unknown
+
+
+def record_outputs(outputs, unknown: dict, files, result, check: bool) -> None:
+    for file, code in zip(files, result):
+        if code != 0 or file not in unknown:
+            continue
+        key, data = unknown[file]
+        if check:
+            store_output(outputs, key, data, data)
+            continue
+        try:
+            output = file.read_bytes()
+        except OSError:
+            continue
+        store_output(outputs, key, data, output)
+        if output != data:
+            store_output(outputs, format_key(output, file), output, output)
+
+
+def relative_name(file: Path) -> str:
+    relative = os.path.relpath(file.absolute(), util.get_git_root())
+    return relative.replace(os.sep, "/")
+
+
+def measure_files(args) -> bool:
+    # per-file times cost the batching, so they are only taken when asked for
+    return bool(args.report or (args.timings and not args.shard))
+
+
+def load_timings(path) -> dict:
+    data = util.read_json_cache(path, {})
+    return data.get("files", {}) if data.get("version") == TIMINGS_VERSION else {}
+
+
+def measured_seconds(records: dict) -> dict:
+    # files answered from the caches never ran, so they have no time of their own
+    return {
+        name: record["seconds"]
+        for name, record in records.items()
+        if not record.get("cached")
+    }
+
+
+def file_record(code: int, seconds) -> dict:
+    if seconds is None:
+        return {"code": code, "cached": True}
+    return {"code": code, "seconds": seconds}
+
+
+def update_timings(path, records: dict) -> None:
+    measured = {
+        name: seconds
+        for name, seconds in measured_seconds(records).items()
+        if seconds > 0
+    }
+    if not measured:
+        return
+    timings = load_timings(path)
+    for name, seconds in measured.items():
+        # smoothed, so one slow run on a busy machine doesn't skew the split
+        previous = timings.get(name)
+        timings[name] = seconds if previous is None else (previous + seconds) / 2
+    util.write_json_cache(path, {"version": TIMINGS_VERSION, "files": timings})
+
+
+def shard_spec(value: str):
+    index, _, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n (e.g. 2/4), got {value!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {index} is not within 1..{count}")
+    return index, count
+
+
+def shard_files(files, index: int, count: int, timings: dict) -> list:
+    """The files for shard index (1-based) of count: longest processing time first,
+    each to the least loaded shard. Only depends on the file list and the timings,
+    so every shard computes the same split."""
+    names = {file: relative_name(file) for file in files}
+    sizes = {}
+    for file in files:
+        try:
+            sizes[file] = max(file.stat().st_size, 1)
+        except OSError:
+            sizes[file] = 1
+    # files without a timing are estimated from their size at the measured rate
+    timed = [file for file in files if names[file] in timings]
+    timed_bytes = sum(sizes[file] for file in timed)
+    rate = sum(timings[names[file]] for file in timed) / timed_bytes if timed else 1.0
+
+    def cost(file):
+        return timings.get(names[file], sizes[file] * rate)
+
+    loads = [0.0] * count
+    shards = [[] for _ in range(count)]
+    for file in sorted(files, key=lambda file: (-cost(file), names[file])):
+        shard = loads.index(min(loads))
+        loads[shard] += cost(file)
+        shards[shard].append(file)
+    return shards[index - 1]
+
+
+def split_digest(files, timings: dict) -> str:
+    """Identifies a split: shards agree on it only if they saw the same files and
+    the same timings."""
+    digest = hashlib.sha1()
+    for name in sorted(relative_name(file) for file in files):
+        digest.update(f"{name}\0{timings.get(name)}\n".encode())
+    return digest.hexdigest()
+
+
+def count_changed_lines(data: bytes, replacements) -> int:
+    # replacement offsets are byte offsets into the original file
+    starts = [0] + [match.end() for match in re.finditer(rb"\n", data)]
+    lines = set()
+    for offset, length in replacements:
+        first = bisect.bisect_right(starts, offset) - 1
+        last = bisect.bisect_right(starts, offset + max(length - 1, 0)) - 1
+        lines.update(range(first, last + 1))
+    return len(lines)
+
+
+def describe_mismatches(files, jobs: int) -> dict:
+    """Replacements clang-format would make to files, as counts of replacements and
+    changed lines per file (from --output-replacements-xml)."""
+    clang_format = get_clang_format_cmd()
+    batches = make_batches(files, jobs)
+    commands = util.run_many(
+        [
+            [clang_format, "--style=file", "--output-replacements-xml"]
+            + [str(file.absolute()) for file in batch]
+            for batch in batches
+        ],
+        jobs=jobs,
+    )
+
+    described = {}
+    for batch, command in zip(batches, commands):
+        # one XML document per file, in the order given
+        documents = [
+            document
+            for document in re.split(rb"(?=<\?xml )", command.stdout)
+            if document.strip()
+        ]
+        if command.returncode != 0 or len(documents) != len(batch):
+            continue
+        for file, document in zip(batch, documents):
+            try:
+                root = ElementTree.fromstring(document)
+                data = file.read_bytes()
+            except (ElementTree.ParseError, OSError):
+                continue
+            replacements = [
+                (int(element.get("offset")), int(element.get("length")))
+                for element in root.iter("replacement")
+            ]
+            described[file] = {
+                "replacements": len(replacements),
+                "changed_lines": count_changed_lines(data, replacements),
+            }
+    return described
+
+
+def summarise(records: dict) -> dict:
+    measured = measured_seconds(records)
+    slowest = sorted(measured.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "files": len(records),
+        "cached": len(records) - len(measured),
+        "failing": sorted(name for name, record in records.items() if record["code"]),
+        "seconds": sum(measured.values()),
+        "slowest": [
+            {"file": name, "seconds": seconds}
+            for name, seconds in slowest[:SLOWEST_FILES]
+            if seconds > 0
+        ],
+    }
+
+
+def print_slowest(summary: dict) -> None:
+    if summary["slowest"]:
+        print("Slowest files:")
+        for entry in summary["slowest"]:
+            print(f"  {entry['seconds'] * 1000:8.1f}ms  {entry['file']}")
+        if summary["cached"]:
+            print(f"  ({summary['cached']} files came from the caches, untimed)")
+
+
+def write_report(path, args, records: dict, split: str = None) -> dict:
+    summary = summarise(records)
+    report = {
+        "version": REPORT_VERSION,
+        "check": args.check,
+        "shard": list(args.shard) if args.shard else None,
+        "split": split,
+        "summary": summary,
+        "files": records,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return summary
+
+
+def merge_reports(args) -> int:
+    """Combine the reports of all shards: print the failures, write the merged
+    report to --report and feed the measured times back into the timings."""
+    records, shards, splits = {}, set(), set()
+    for path in args.merge:
+        with open(path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+        if report.get("version") != REPORT_VERSION:
+            print(f"Error: {path} is not a format report this version understands")
+            return 1
+        records.update(report["files"])
+        if report.get("shard"):
+            shards.add(tuple(report["shard"]))
+            splits.add(report.get("split"))
+
+    if len(splits) > 1:
+        # their files would overlap or leave gaps
+        print("Error: the shards split different file lists or timings")
+        return 1
+
+    counts = {count for _, count in shards}
+    if len(counts) == 1:
+        (count,) = counts
+        missing = sorted(set(range(1, count + 1)) - {index for index, _ in shards})
+        if missing:
+            print(f"Warning: no report for shard(s) {', '.join(map(str, missing))}")
+
+    if args.timings:
+        update_timings(args.timings, records)
+    if args.report:
+        args.shard = None
+        write_report(args.report, args, records)
+
+    summary = summarise(records)
+    for name in summary["failing"]:
+        changed = records[name].get("changed_lines")
+        details = f" ({changed} lines)" if changed is not None else ""
+        print(f"{name}: code should be clang-formatted{details}")
+    print_slowest(summary)
+    print(f"{summary['files']} files, {len(summary['failing'])} failing")
+    return 1 if summary["failing"] else 0
+
+
+def watch_files(args, files_and_directories, ignore) -> int:
+    recursive = not args.no_recursive
+    root = util.get_git_root()
+    pruned = {os.path.abspath(root / d) for d in util.PRUNED_DIRECTORIES}
+    paths = [path.absolute() for path in files_and_directories]
+    directories = [path if path.is_dir() else path.parent for path in paths]
+
+    def skip_directory(path: str) -> bool:
+        return not recursive or path in pruned or ignore.match(path, True)
+
+    def accept(path: Path) -> bool:
+        return (
+            path.name.endswith(util.SOURCE_SUFFIXES)
+            and in_scope(path, paths, recursive)
+            and path.is_file()
+            and not ignore.match(path, False)
+        )
+
+    # mtimes of files as we left them, so our own rewrites don't trigger a rerun
+    written = {}
+
+    def on_change(changed_paths, overflowed):
+        if overflowed:
+            # the kernel dropped events: look at everything (the caches keep it cheap)
+            files = collect_files(args, paths, ignore)[0]
+        else:
+            files = [path for path in map(Path, changed_paths) if accept(path)]
+        files = [file for file in files if written.get(file) != mtime(file)]
+        if not files:
+            return
+        format_files(args, files, {})
+        written.update((file, mtime(file)) for file in files)
+
+    watcher = watcher_module.create(directories, skip_directory)
+    inotify = isinstance(watcher, watcher_module.InotifyWatcher)
+    kind = "inotify" if inotify else "polling"
+    names = ", ".join(str(path) for path in files_and_directories)
+    print(f"Watching {names} for changes ({kind}, Ctrl-C to stop)", flush=True)
+    try:
+        watcher_module.watch(watcher, on_change)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
 
 
-def format_stdio(filename: str):
-    command = [get_clang_format_cmd(), "--style=file", "--assume-filename", filename]
-    return util.run(command)
+def mtime(path: Path):
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def format_stdio(filename: str, use_cache: bool = True):
+    data = sys.stdin.buffer.read()
+    path = Path(filename)
+    outputs = util.ContentCache("formatted") if use_cache else None
+    key = format_key(data, path) if outputs else None
+    output = cached_output(outputs, key, data) if outputs else None
+    if output is None:
+        command = [get_clang_format_cmd(), "--style=file"]
+        command += ["--assume-filename", filename]
+        process = subprocess.run(command, input=data, stdout=subprocess.PIPE)
+        output = process.stdout
+        if process.returncode != 0:
+            sys.stdout.buffer.write(output)
+            return process.returncode
+        if outputs:
+            store_output(outputs, key, data, output)
+    sys.stdout.buffer.write(output)
+    sys.stdout.flush()
+    return 0
+
+
+def format_staged(args, files_and_directories, ignore) -> int:
+    """Check what is staged for the next commit, leaving the worktree alone."""
+    blobs = {
+        file: blob
+        for file, blob in staged_blobs().items()
+        if file.name.endswith(util.SOURCE_SUFFIXES)
+        and in_scope(file, files_and_directories, not args.no_recursive)
+        and not ignore.match(file, False)
+    }
+    contents = read_blobs(blobs.values())
+    files = [file for file in blobs if blobs[file] in contents]
+
+    outputs = None if args.no_cache else util.ContentCache("formatted")
+    codes, seconds, keys = {}, {}, {}
+    for file in files:
+        data = contents[blobs[file]]
+        keys[file] = format_key(data, file)
+        output = cached_output(outputs, keys[file], data) if outputs else None
+        if output is not None:
+            codes[file] = 0 if output == data else 1
+
+    # the blobs go straight to clang-format's stdin, as with --stdio
+    pending = [file for file in files if file not in codes]
+    clang_format = get_clang_format_cmd()
+    commands = [
+        [clang_format, "--style=file", "--assume-filename", str(file)]
+        for file in pending
+    ]
+    progress = None
+    if not args.quiet and not args.verbose:
+        progress = util.Progress(len(pending), "Checking staged: ")
+
+    def finished(index, command):
+        if args.verbose:
+            print(f"Checking staged {pending[index]}", flush=True)
+        if progress:
+            progress.update()
+
+    commands = util.run_many(
+        commands,
+        jobs=args.jobs,
+        input=[contents[blobs[file]] for file in pending],
+        on_complete=finished,
+    )
+    if progress:
+        progress.close()
+
+    for file, command in zip(pending, commands):
+        seconds[file] = command.elapsed
+        if command.returncode != 0:
+            command.echo()
+            codes[file] = command.returncode or 1
+            continue
+        data = contents[blobs[file]]
+        if outputs:
+            store_output(outputs, keys[file], data, command.stdout)
+        codes[file] = 0 if command.stdout == data else 1
+
+    for file in files:
+        if codes[file] == 1:
+            print(
+                f"{file}: error: staged code should be clang-formatted",
+                file=sys.stderr,
+            )
+
+    if args.report:
+        records = {
+            relative_name(file): file_record(codes[file], seconds.get(file))
+            for file in files
+        }
+        summary = write_report(args.report, args, records)
+        if not args.quiet:
+            print_slowest(summary)
+
+    if any(codes.values()):
+        print("Done, formatting mismatch detected")
+        return 1
+
+    print("Done!")
+    return 0
 
 
 def argparser() -> argparse.ArgumentParser:
@@ -117,6 +694,57 @@ def argparser() -> argparse.ArgumentParser:
     parser.add_argument(
         "-c", "--check", help="check for format compliance locally", action="store_true"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of parallel jobs (defaults to the number of CPUs)",
+        type=int,
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="process every file, even those already known to be formatted",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--changed",
+        help="only format the lines changed relative to the index (or --base)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--base",
+        help="git ref to compare against for --changed (implies --changed)",
+        type=str,
+    )
+    parser.add_argument(
+        "--staged",
+        help="check the staged contents of files added or changed in the index (implies --check)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        help="keep running, formatting files as they change",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard",
+        help="only process shard i of n (e.g. 2/4), balanced by past per-file timings",
+        type=shard_spec,
+    )
+    parser.add_argument(
+        "--timings",
+        help="per-file timings file: balances --shard (required with it), updated with measured times by unsharded runs and --merge",
+        type=Path,
+    )
+    parser.add_argument(
+        "--report", help="write a JSON report of the per-file results", type=str
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="REPORT",
+        help="merge the reports of several shards (with --report, write the result)",
+    )
     parser.add_argument(
         "-i",
         "--stdio",
@@ -131,6 +759,13 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+def resources(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.check or args.staged:
+        return {"sources"}, set()
+    return set(), {"sources"}
+
+
 def main() -> int:
     args = argparser().parse_args()
     if args.stdio:
@@ -141,50 +776,183 @@ def main() -> int:
         if not Path(filename).is_file():
             print("Error: must specify a valid file name when using stdio")
             return 1
-        return format_stdio(filename)
+        return format_stdio(filename, not args.no_cache)
+    if args.merge:
+        return merge_reports(args)
 
     files_and_directories = (
         [Path(f) for f in args.files_and_directories]
         if args.files_and_directories
         else [util.get_git_root().absolute() / p for p in ["src", "tests"]]
     )
-    temp = [[], []]
-    directories, files = temp
-    for is_file, group in groupby(files_and_directories, lambda p: p.is_file()):
-        for thing in group:
-            temp[is_file].append(thing)
+    ignore = util.IgnoreMatcher.from_file(util.get_git_root() / ".clang-format-ignore")
+    if args.staged:
+        if args.changed or args.base or args.watch or args.shard:
+            print(
+                "Error: --staged can't be combined with --changed/--base/--watch/--shard"
+            )
+            return 1
+        # the index is only ever checked, never rewritten
+        args.check = True
+        return format_staged(args, files_and_directories, ignore)
+    if args.watch:
+        if args.changed or args.base:
+            print("Error: --watch can't be combined with --changed/--base")
+            return 1
+        return watch_files(args, files_and_directories, ignore)
 
-    found_files = set(
-        file
-        for dir in directories
-        for file in get_header_and_source_files(dir, not args.no_recursive)
-    )
-    remaining_files = set(files).difference(found_files)
-    valid_files = get_valid_header_and_source_files(remaining_files)
-    files = found_files.union(valid_files)
+    if args.shard and not args.timings:
+        # a per-machine default would let shards with different caches disagree
+        print("Error: --shard needs --timings, the same file for every shard")
+        return 1
+
+    files, lines = collect_files(args, files_and_directories, ignore)
+    split = None
+    if args.shard:
+        index, count = args.shard
+        total = len(files)
+        timings = load_timings(args.timings)
+        split = split_digest(files, timings)
+        files = shard_files(files, index, count, timings)
+        if not args.quiet:
+            print(f"Shard {index}/{count}: {len(files)} of {total} files")
+    return format_files(args, files, lines, split)
+
+
+def collect_files(args, files_and_directories, ignore):
+    lines = {}
+    if args.changed or args.base:
+        # ask git rather than walking the tree, so the work scales with the diff
+        lines = changed_lines(args.base)
+        files = [
+            file
+            for file in lines
+            if file.name.endswith(util.SOURCE_SUFFIXES)
+            and in_scope(file, files_and_directories, not args.no_recursive)
+            and not ignore.match(file, False)
+        ]
+    else:
+        temp = [[], []]
+        directories, files = temp
+        for is_file, group in groupby(files_and_directories, lambda p: p.is_file()):
+            for thing in group:
+                temp[is_file].append(thing)
+
+        # ignored directories are pruned during the walk, never read
+        found_files = set(
+            file
+            for dir in directories
+            for file in util.get_header_and_source_files(
+                dir, not args.no_recursive, ignore=ignore, cache=True
+            )
+        )
+        remaining_files = set(files).difference(found_files)
+        valid_files = get_valid_header_and_source_files(remaining_files)
+        # files named explicitly weren't filtered by the walk
+        valid_files = [file for file in valid_files if not ignore.match(file, False)]
+        files = found_files.union(valid_files)
 
-    excludes = excludes_from_file(".clang-format-ignore")
-    files = exclude(files, excludes)
+    return files, lines
+
+
+def format_files(args, files, lines, split: str = None) -> int:
+    requested = list(files)
+
+    # skip files already known to be formatted with this clang-format and style
+    results = None
+    if not args.no_cache:
+        results = util.ResultCache("format", get_clang_format_version())
+        files = [
+            file
+            for file in files
+            if results.get(file, get_style_config(file.absolute().parent)) is None
+        ]
 
     check = args.check
 
-    if args.quiet:
-        result = util.do_parallel(
-            partial(format_file, get_clang_format_cmd(), False, check), files
-        )
-    elif args.verbose:
-        clang_format = get_clang_format_cmd()
-        # Single-process for output purposes :/
-        result = [0] * len(files)
-        for i, file in enumerate(files):
-            result[i] = format_file(clang_format, True, check, file)
-            print(f"Formatting {file}")
+    # the same bytes format the same way whatever the path, e.g. across checkouts
+    outputs = known = unknown = None
+    if not args.no_cache and not lines:
+        outputs = util.ContentCache("formatted")
+        known, unknown = lookup_outputs(outputs, files, check)
+        files = [file for file in files if file not in known]
+
+    # clang-format is started straight from an event loop, many files per run
+    clang_format = get_clang_format_cmd()
+    if lines or measure_files(args):
+        # --lines only works on one file per clang-format run, and only then is a
+        # run's wall time the time that file took
+        batches = [[file] for file in files]
+        commands = [
+            format_command(clang_format, check, [file], lines.get(file, ()))
+            for file in files
+        ]
     else:
-        result = util.do_parallel_progressbar(
-            partial(format_file, get_clang_format_cmd(), False, check),
-            files,
-            "Formatting: ",
+        batches = make_batches(files, args.jobs or multiprocessing.cpu_count())
+        commands = [format_command(clang_format, check, batch) for batch in batches]
+    progress = None
+    if not args.quiet and not args.verbose:
+        progress = util.Progress(len(files), "Formatting: ")
+
+    def finished(index, command):
+        command.echo()
+        if args.verbose:
+            for file in batches[index]:
+                print(f"Formatting {file.absolute()}", flush=True)
+        if progress:
+            progress.update(len(batches[index]))
+
+    commands = util.run_many(commands, jobs=args.jobs, on_complete=finished)
+    if progress:
+        progress.close()
+    files = [file for batch in batches for file in batch]
+    ran = set(files)
+    result = [
+        code
+        for batch, command in zip(batches, commands)
+        for code in batch_results(batch, command)
+    ]
+
+    seconds = {
+        batch[0]: command.elapsed
+        for batch, command in zip(batches, commands)
+        if len(batch) == 1
+    }
+
+    if outputs:
+        record_outputs(outputs, unknown, files, result, check)
+        files += list(known)
+        result += list(known.values())
+
+    # a clean run over some lines says nothing about the rest of the file
+    if results and not lines:
+        for file, code in zip(files, result):
+            if code == 0:
+                results.put(file, code, get_style_config(file.absolute().parent))
+        results.save()
+
+    # files skipped through the caches are known to pass
+    codes = dict(zip(files, result))
+    records = {
+        relative_name(file): file_record(
+            codes.get(file, 0), seconds.get(file, 0.0) if file in ran else None
         )
+        for file in requested
+    }
+    # shards leave the timings alone so they all split the same way; their reports
+    # carry the measurements to --merge instead
+    if args.timings and not lines and not args.shard:
+        update_timings(args.timings, records)
+    if args.report:
+        # what exactly is wrong with each file, so CI needn't rerun verbosely
+        failing = [file for file in requested if codes.get(file, 0) != 0]
+        if check and failing:
+            jobs = args.jobs or multiprocessing.cpu_count()
+            for file, details in describe_mismatches(failing, jobs).items():
+                records[relative_name(file)].update(details)
+        summary = write_report(args.report, args, records, split)
+        if not args.quiet:
+            print_slowest(summary)
 
     if any(map(lambda x: x != 0, result)):
         print("Done, formatting mismatch detected")
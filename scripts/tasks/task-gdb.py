@@ -1,10 +1,9 @@
 #! /usr/bin/env python3
 import argparse
-import importlib
 import subprocess
-import sys
 from pathlib import Path
 import os
+import util
 
 # Based on dbt_tools/gdb.py by litui
 
@@ -15,6 +14,8 @@ def argparser() -> argparse.ArgumentParser:
         description="Open a GDB remote for the proper target",
     )
     parser.group = "Debugging"
+    # interactive, needs to own the controlling terminal
+    parser.serve = False
     parser.add_argument("-nb", "--no-build", action="store_true")
     parser.add_argument(
         "target",
@@ -26,14 +27,21 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+def build_target(target: str) -> str:
+    return f"dbt-build-debug-{target}"
+
+
+def prerequisites(argv) -> list:
+    args = argparser().parse_args(argv[1:])
+    if args.no_build:
+        return []
+    return [["build", build_target(args.target)]]
+
+
 def main() -> int:
     args = argparser().parse_args()
 
-    scons_target = f"dbt-build-debug-{args.target}"
-
-    if not args.no_build:
-        sys.argv = ["build", scons_target]
-        importlib.import_module("task-build").main()
+    scons_target = build_target(args.target)
 
     elf_path = Path(scons_target) / f"Deluge-debug-{args.target}.elf"
 
@@ -41,7 +49,7 @@ def main() -> int:
 
     result = subprocess.run(
         [
-            "arm-none-eabi-gdb",
+            util.get_tool("arm-none-eabi-gdb"),
             "-ex",
             f"source {str(gdbinit)}",
             "-ex",
@@ -35,8 +35,12 @@ def license_file(dry_run: bool, verbose: bool, path: Path):
         file.fileno(), 0, access=mmap.ACCESS_READ
     ) as s:
         found = s.find(LICENSE_CHECK.encode()) != -1
+    if verbose and not found:
+        print(f"Adding license to {path}")
     if not dry_run and not found:
         util.prepend_file(LICENSE_TEMPLATE, Path(path))
+        found = True
+    return found
 
 
 def argparser() -> argparse.ArgumentParser:
@@ -60,24 +64,72 @@ def argparser() -> argparse.ArgumentParser:
     parser.add_argument(
         "-v", "--verbose", help="print the changes happening", action="store_true"
     )
+    parser.add_argument(
+        "--no-cache",
+        help="check every file, even those already known to be licensed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of parallel jobs (defaults to the number of CPUs)",
+        type=int,
+    )
     parser.add_argument("directory", help="the directory of source files to format")
     return parser
 
 
+def inputs_outputs(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.dry_run:
+        return None
+    # licensing rewrites the files it checks, so they are both inputs and outputs
+    files = util.get_header_and_source_files(
+        Path(args.directory), args.recursive, cache=True
+    )
+    return files, files
+
+
+def resources(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.dry_run:
+        return {"sources"}, set()
+    return set(), {"sources"}
+
+
 def main() -> int:
     args = argparser().parse_args()
-    files = util.get_header_and_source_files(Path(args.directory), args.recursive)
+    files = util.get_header_and_source_files(
+        Path(args.directory), args.recursive, cache=True
+    )
     if files:
+        # skip files already known to carry the license
+        results = None
+        if not args.no_cache:
+            results = util.ResultCache("license", LICENSE_CHECK)
+            files = [file for file in files if results.get(file) is None]
+
         if args.quiet:
-            util.do_parallel(partial(license_file, args.dry_run, False), files)
+            found = util.do_parallel(
+                partial(license_file, args.dry_run, False), files, jobs=args.jobs
+            )
         elif args.verbose:
-            # Single-process for output purposes :/
-            for file in files:
-                license_file(args.dry_run, True, file)
+            found = util.do_parallel_buffered(
+                partial(license_file, args.dry_run, True), files, jobs=args.jobs
+            )
         else:
-            util.do_parallel_progressbar(
-                partial(license_file, args.dry_run, False), files, "Formatting: "
+            found = util.do_parallel_progressbar(
+                partial(license_file, args.dry_run, False),
+                files,
+                "Formatting: ",
+                jobs=args.jobs,
             )
+
+        if results:
+            for file, licensed in zip(files, found):
+                if licensed:
+                    results.put(file, True)
+            results.save()
         print("Done!")
         return 0
     else:
@@ -61,6 +61,10 @@ def argparser():
     return parser
 
 
+def resources(argv):
+    return {"build"}, {"device"}
+
+
 def pack_8_to_7_bits(src, dstsize):
     packets = (len(src) + 6) // 7
     dst = bytearray(dstsize)
@@ -23,6 +23,10 @@ def readonly_handler(func, path, execinfo):
     func(path)
 
 
+def resources(argv):
+    return set(), {"build", "tests-build"}
+
+
 def main() -> int:
     build_dirs = util.get_git_root().glob("*build*")
     for dir in build_dirs:
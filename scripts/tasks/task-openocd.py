@@ -3,9 +3,9 @@ import argparse
 from enum import Enum
 from pathlib import Path
 import subprocess
-import shutil
 import sys
 import os
+import util
 
 
 # Based on dbt_tools/openocd.py by litui
@@ -24,9 +24,6 @@ class ExitCodes(Enum):
     OPENOCD_UNSUPPORTED_PROTOCOL = 6
 
 
-__OPENOCD_BIN = shutil.which("openocd")
-
-OPENOCD = __OPENOCD_BIN
 OPENOCD_SCRIPT_DIR = os.path.join(os.environ["DBT_DEBUG_DIR"], "openocd")
 OPENOCD_OPTS = []
 OPENOCD_COMMAND = []
@@ -77,10 +74,11 @@ def _get_acceptable_protocol(hardware, protocol):
 
 
 def exists():
-    if not OPENOCD:
+    openocd = util.find_tool("openocd")
+    if not openocd:
         raise FileNotFoundError("Could not detect openocd")
 
-    return OPENOCD
+    return openocd
 
 
 def argparser() -> argparse.ArgumentParser:
@@ -89,6 +87,8 @@ def argparser() -> argparse.ArgumentParser:
         description="Run OpenOCD with default arguments (CMSIS-DAP/DelugeProbe).\nThese can be changed using the OPENOCD_OPTS variable.",
     )
     parser.group = "Debugging"
+    # interactive, needs to own the controlling terminal
+    parser.serve = False
     parser.add_argument(
         "-v",
         "--verbose",
@@ -118,7 +118,7 @@ def main() -> int:
 
     cfg_files = _OPENOCD_CONFIG_MAP[hardware][protocol]
 
-    ocd_cmd = [__OPENOCD_BIN]
+    ocd_cmd = [util.get_tool("openocd")]
     for cfg_part in cfg_files:
         ocd_cmd.append("-f")
         path = os.path.join(OPENOCD_SCRIPT_DIR, cfg_part)
@@ -12,6 +12,8 @@ def argparser() -> argparse.ArgumentParser:
         description="Run SCons in the current environment (deprecated)",
     )
     parser.group = "Building"
+    # takes the rest of the command line, even if it names other tasks
+    parser.pipeline = False
     return parser
 
 
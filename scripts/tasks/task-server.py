@@ -0,0 +1,63 @@
+#! /usr/bin/env python3
+import argparse
+import os
+import sys
+from pathlib import Path
+import dbtserver
+import util
+
+
+def argparser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="server",
+        description="Keep dbt and its tasks loaded so editor integrations (e.g. format --stdio) respond instantly",
+    )
+    parser.group = "Development"
+    # takes the rest of the command line, even if it names other tasks
+    parser.pipeline = False
+    parser.serve = False
+    parser.add_argument(
+        "-s", "--stop", help="stop the running server", action="store_true"
+    )
+    parser.add_argument(
+        "-t",
+        "--idle-timeout",
+        help="exit after this many minutes without requests",
+        type=float,
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="log every request to stderr", action="store_true"
+    )
+    return parser
+
+
+def main() -> int:
+    args = argparser().parse_args()
+
+    if not dbtserver.is_supported():
+        print("The dbt server requires Unix domain sockets and fork()")
+        return 1
+
+    if args.stop:
+        if not dbtserver.stop():
+            print("No dbt server running")
+            return 1
+        return 0
+
+    root = util.get_git_root()
+    os.chdir(root)
+    path = dbtserver.socket_path()
+
+    server = dbtserver.Server(Path("scripts/tasks"), args.verbose)
+    server.preload()
+    print(
+        f"dbt server listening on {path} (serving {', '.join(sorted(server.modules))})"
+    )
+
+    restart_argv = [sys.executable, str(root / "dbt.py")] + sys.argv
+    idle_timeout = args.idle_timeout * 60 if args.idle_timeout else None
+    return server.serve_forever(path, restart_argv, idle_timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
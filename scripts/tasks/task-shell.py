@@ -27,6 +27,10 @@ def argparser() -> argparse.ArgumentParser:
         description="Open a shell in the DBT environment",
     )
     parser.group = "Development"
+    # takes the rest of the command line, even if it names other tasks
+    parser.pipeline = False
+    # interactive, needs to own the controlling terminal
+    parser.serve = False
     return parser
 
 
@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+import argparse
+import contextlib
+import json
+import statistics
+import sys
+from collections import defaultdict
+from datetime import datetime
+import history
+
+# a run is flagged as a regression when it is this much slower than the median
+REGRESSION_RATIO = 1.2
+REGRESSION_MIN_SECONDS = 1.0
+
+
+def argparser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stats",
+        description="Report trends, slowest tasks and regressions from the local task run history",
+    )
+    parser.group = "Development"
+    parser.add_argument(
+        "-n",
+        "--last",
+        help="number of runs per task/arguments to consider",
+        default=20,
+        type=int,
+    )
+    parser.add_argument("-t", "--task", help="only report on this task", type=str)
+    parser.add_argument(
+        "-p",
+        "--phases",
+        help="include per-phase timings (e.g. configure/build/test)",
+        action="store_true",
+    )
+    return parser
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds >= 60:
+        return f"{int(seconds // 60)}m{seconds % 60:04.1f}s"
+    return f"{seconds:.2f}s"
+
+
+def load_runs(db, task: str, last: int) -> dict:
+    query = "SELECT id, task, argv, started, wall, exit_code, revision, cores FROM runs"
+    params = ()
+    if task:
+        query += " WHERE task = ?"
+        params = (task,)
+    query += " ORDER BY started"
+
+    # group by the full command line, so e.g. `build release` and `build debug` trend separately
+    groups = defaultdict(list)
+    for row in db.execute(query, params):
+        run_id, name, argv, started, wall, exit_code, revision, cores = row
+        key = " ".join([name] + json.loads(argv))
+        groups[key].append(
+            {
+                "id": run_id,
+                "started": started,
+                "wall": wall,
+                "exit_code": exit_code,
+                "revision": revision,
+                "cores": cores,
+            }
+        )
+    return {key: runs[-last:] for key, runs in groups.items()}
+
+
+def print_slowest(groups: dict) -> None:
+    print("Slowest tasks (median of successful runs):")
+    rows = []
+    for key, runs in groups.items():
+        walls = [run["wall"] for run in runs if run["exit_code"] == 0]
+        if walls:
+            failures = len(runs) - len(walls)
+            median = statistics.median(walls)
+            rows.append((median, max(walls), len(runs), failures, key))
+    for median, worst, count, failures, key in sorted(rows, reverse=True)[:10]:
+        print(
+            f"  {key:<40} median {format_seconds(median):>9}  max {format_seconds(worst):>9}"
+            f"  runs {count:>3}  failed {failures:>3}"
+        )
+
+
+def print_trends(groups: dict) -> None:
+    print("Trends (oldest to newest):")
+    for key, runs in sorted(groups.items()):
+        if len(runs) < 2:
+            continue
+        walls = " ".join(
+            format_seconds(run["wall"]) if run["exit_code"] == 0 else "FAIL"
+            for run in runs
+        )
+        print(f"  {key:<40} {walls}")
+
+
+def print_regressions(groups: dict) -> None:
+    print("Regressions (latest run vs. median of the previous runs):")
+    found = False
+    for key, runs in sorted(groups.items()):
+        successful = [run for run in runs if run["exit_code"] == 0]
+        if len(successful) < 3:
+            continue
+        latest = successful[-1]
+        baseline = statistics.median(run["wall"] for run in successful[:-1])
+        if (
+            latest["wall"] > baseline * REGRESSION_RATIO
+            and latest["wall"] - baseline > REGRESSION_MIN_SECONDS
+        ):
+            found = True
+            when = datetime.fromtimestamp(latest["started"]).strftime("%Y-%m-%d %H:%M")
+            revision = (latest["revision"] or "unknown")[:10]
+            print(
+                f"  {key:<40} {format_seconds(latest['wall'])} vs {format_seconds(baseline)}"
+                f" ({latest['wall'] / baseline:.1f}x) at {revision} on {when}"
+                f" with {latest['cores']} cores"
+            )
+    if not found:
+        print("  none")
+
+
+def print_phases(db, groups: dict) -> None:
+    print("Phases (median over the considered runs):")
+    for key, runs in sorted(groups.items()):
+        ids = [run["id"] for run in runs if run["exit_code"] == 0]
+        if not ids:
+            continue
+        placeholders = ",".join("?" * len(ids))
+        phases = defaultdict(list)
+        for name, wall in db.execute(
+            f"SELECT name, wall FROM phases WHERE run_id IN ({placeholders})", ids
+        ):
+            phases[name].append(wall)
+        if phases:
+            summary = "  ".join(
+                f"{name} {format_seconds(statistics.median(walls))}"
+                for name, walls in phases.items()
+            )
+            print(f"  {key:<40} {summary}")
+
+
+def main() -> int:
+    args = argparser().parse_args()
+
+    with contextlib.closing(history.connect()) as db:
+        groups = load_runs(db, args.task, max(args.last, 1))
+        if not groups:
+            print("No task runs recorded yet")
+            return 0
+
+        print_slowest(groups)
+        print("")
+        print_trends(groups)
+        print("")
+        print_regressions(groups)
+        if args.phases:
+            print("")
+            print_phases(db, groups)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
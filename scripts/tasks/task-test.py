@@ -3,6 +3,7 @@ import argparse
 import os
 import subprocess
 import sys
+import history
 import util
 
 
@@ -18,8 +19,12 @@ def argparser() -> argparse.ArgumentParser:
     return parser
 
 
+def resources(argv):
+    return {"sources"}, {"tests-build"}
+
+
 def cmake_build() -> int:
-    cmake_args = ["cmake"]
+    cmake_args = [util.get_tool("cmake")]
     cmake_args += ["--build", "build/tests/"]
 
     return subprocess.run(cmake_args, env=os.environ).returncode
@@ -35,7 +40,7 @@ def cmake_test() -> int:
 
 
 def cmake_configure() -> int:
-    cmake_args = ["cmake"]
+    cmake_args = [util.get_tool("cmake")]
     cmake_args += ["-S", "tests/"]
     cmake_args += ["-B", "build/tests"]
     cmake_args += ["-G", "Ninja Multi-Config"]  # generator
@@ -49,15 +54,18 @@ def main() -> int:
     os.chdir(util.get_git_root())
 
     if not os.path.exists("build/tests"):
-        result = cmake_configure()
+        with history.phase("configure"):
+            result = cmake_configure()
         if result != 0:
             return result
 
-    build = cmake_build()
+    with history.phase("build"):
+        build = cmake_build()
     if build != 0 or args.no_run:
         return build
 
-    return cmake_test()
+    with history.phase("test"):
+        return cmake_test()
 
 
 if __name__ == "__main__":
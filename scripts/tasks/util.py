@@ -1,15 +1,24 @@
-from functools import partial
+import atexit
+import collections
+from dataclasses import dataclass
+from functools import cache, partial
+import hashlib
 import itertools
+import json
 import multiprocessing
 import os
+import queue
 import re
 import subprocess
 import sys
 import shutil
+import signal
 import sysconfig
+import tempfile
 from pathlib import Path
 import time
-import fileinput
+import jobserver
+import glob
 
 
 def run(args, redirect_input: bool = True, redirect_output: bool = True):
@@ -43,25 +52,76 @@ def absolute_path_str(path: str):
     return str(Path(path).absolute())
 
 
-def get_header_and_source_files(path: Path, recursive: bool):
-    glob = path.rglob if recursive else path.glob
-    globs = [
-        glob("*.cc"),
-        glob("*.hh"),
-        glob("*.[ch]xx"),
-        glob("*.[ch]pp"),
-        glob("*.[ch]"),
-    ]
-    return [file for files in globs for file in list(files)]
+def get_header_and_source_files(
+    path: Path, recursive: bool, ignore=None, cache: bool = False
+):
+    return find_files(path, SOURCE_SUFFIXES, recursive, ignore, cache)
+
+
+UTF8_BOM = b"\xef\xbb\xbf"
+
+
+def _write_all(fd: int, data: bytes) -> int:
+    """os.write until all of data is written (it may write less), returning its size."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+    return len(data)
+
+
+def _copy_to_end(source: int, destination: int) -> None:
+    """Copy the rest of source to destination, from and to their current positions,
+    inside the kernel where the platform and filesystems allow it."""
+    remaining = os.fstat(source).st_size - os.lseek(source, 0, os.SEEK_CUR)
+    copiers = []
+    if hasattr(os, "copy_file_range"):
+        copiers.append(lambda count: os.copy_file_range(source, destination, count))
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        copiers.append(lambda count: os.sendfile(destination, source, None, count))
+    # both advance the file positions, so a failed copier leaves the rest to the next
+    copiers.append(lambda count: _write_all(destination, os.read(source, 1 << 20)))
+
+    for copy in copiers:
+        try:
+            while remaining > 0:
+                copied = copy(remaining)
+                if not copied:
+                    return  # the file shrank under us
+                remaining -= copied
+            return
+        except OSError:
+            if copy is copiers[-1]:
+                raise
 
 
 def prepend_file(text: str, path: Path) -> None:
-    for linenum, line in enumerate(fileinput.FileInput(path.absolute(), inplace=1)):
-        if linenum == 0:
-            print(text)
-            print(line.rstrip())
-        else:
-            print(line.rstrip())
+    """Put text (and a line break) before the file's content, leaving the original
+    bytes untouched. The header uses the file's own line endings, and the file is
+    replaced atomically."""
+    path = Path(path).absolute()
+    with open(path, "rb", 0) as source:
+        start = source.read(64 * 1024)
+        bom = UTF8_BOM if start.startswith(UTF8_BOM) else b""
+        newline = b"\n"
+        first_line_end = start.find(b"\n")
+        if first_line_end > 0 and start[first_line_end - 1 : first_line_end] == b"\r":
+            newline = b"\r\n"
+        header = bom + text.encode().replace(b"\n", newline) + newline
+
+        fd, tmp = tempfile.mkstemp(
+            prefix=f".{path.name}.", suffix=".tmp", dir=path.parent
+        )
+        try:
+            with open(fd, "wb") as destination:
+                destination.write(header)
+                destination.flush()
+                source.seek(len(bom))
+                _copy_to_end(source.fileno(), destination.fileno())
+            shutil.copymode(path, tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
 
 
 def convert_path_if_mingw(path: str) -> str:
@@ -70,98 +130,517 @@ def convert_path_if_mingw(path: str) -> str:
     return path
 
 
+@dataclass(frozen=True)
+class Context:
+    root: Path
+    toolchain_version: str
+    # DBT_TOOLCHAIN_PATH, the directory containing toolchain/
+    toolchain_path: Path
+    # toolchain/v<version> for the required version
+    toolchain_dir: Path
+    build_dir: Path
+
+
+def _is_inherited_root(root: str) -> bool:
+    # only trust an inherited root if it is still a firmware checkout we're inside of
+    if not root:
+        return False
+    root = Path(root)
+    if not (root / "toolchain" / "REQUIRED_VERSION").is_file():
+        return False
+    return Path.cwd().resolve().is_relative_to(root.resolve())
+
+
+@cache
+def get_context() -> Context:
+    root = os.environ.get("DELUGE_FW_ROOT")
+    if not _is_inherited_root(root):
+        root = run_get_output(["git", "rev-parse", "--show-toplevel"])
+        root = convert_path_if_mingw(root)
+    root = Path(root)
+
+    with open(root / "toolchain" / "REQUIRED_VERSION") as f:
+        toolchain_version = f.readline().rstrip()
+    toolchain_path = Path(os.environ.get("DBT_TOOLCHAIN_PATH") or root)
+
+    # export so nested tasks and child processes resolve the same context for free
+    os.environ["DELUGE_FW_ROOT"] = str(root)
+    os.environ["DBT_TOOLCHAIN_PATH"] = str(toolchain_path)
+
+    return Context(
+        root=root,
+        toolchain_version=toolchain_version,
+        toolchain_path=toolchain_path,
+        toolchain_dir=toolchain_path / "toolchain" / f"v{toolchain_version}",
+        build_dir=root.absolute() / "build",
+    )
+
+
 def get_git_root() -> Path:
-    git_root = run_get_output(["git", "rev-parse", "--show-toplevel"])
-    git_root = convert_path_if_mingw(git_root)
-    return Path(git_root)
-
-
-# from https://stackoverflow.com/a/34482761
-def progressbar(it, prefix: str, size: int = 60, out=sys.stdout):
-    count = len(it)
-
-    def show(j):
-        x = int(size * j / count)
-        print(
-            f"{prefix}[{u'#'*x}{('-'*(size-x))}] {j}/{count}",
-            end="\r",
-            file=out,
-            flush=True,
-        )
+    return get_context().root
 
-    show(0)
-    for i, item in enumerate(it):
-        yield item
-        show(i + 1)
-    print("", flush=True, file=out)
 
+def get_git_dirs():
+    """The checkout's own git directory and the common one (they differ in linked
+    worktrees, which keep HEAD to themselves but share refs), or None outside git."""
+    git_dir = get_context().root / ".git"
+    try:
+        if git_dir.is_file():
+            git_dir = git_dir.parent / git_dir.read_text().split(":", 1)[1].strip()
+        common_dir = git_dir
+        if (git_dir / "commondir").is_file():
+            common_dir = git_dir / (git_dir / "commondir").read_text().strip()
+    except (OSError, IndexError):
+        return None
+    if not git_dir.is_dir():
+        return None
+    return git_dir, common_dir.resolve()
 
-def do_parallel(func, it):
-    pool = multiprocessing.Pool()
-    result = pool.map_async(func, it)
-    while not result.ready():
-        time.sleep(1)
-    pool.close()
-    pool.join()
 
-    return result.get()
+def get_git_revision() -> str | None:
+    # read HEAD straight from .git so recording a revision never forks git
+    dirs = get_git_dirs()
+    if dirs is None:
+        return None
+    git_dir, common_dir = dirs
+    try:
+        head = (git_dir / "HEAD").read_text().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        for directory in (git_dir, common_dir):
+            if (directory / ref).is_file():
+                return (directory / ref).read_text().strip()
+        with open(common_dir / "packed-refs") as f:
+            for line in f:
+                if line.rstrip().endswith(" " + ref):
+                    return line.split(" ", 1)[0]
+    except OSError:
+        pass
+    return None
 
 
-class Counter(object):
-    def __init__(self, initval=0):
-        self.val = multiprocessing.RawValue("i", initval)
-        self.lock = multiprocessing.Lock()
+## Progress reporting
 
-    def increment(self):
-        with self.lock:
-            self.val.value += 1
 
-    @property
-    def value(self):
-        return self.val.value
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class Progress:
+    """Progress bar with rate and ETA. Redraws at most every `interval` seconds and
+    only when the text changes; when not attached to a terminal (CI logs) it prints
+    one line per `milestones`th of the work instead."""
+
+    def __init__(
+        self,
+        total: int,
+        prefix: str,
+        size: int = 60,
+        out=None,
+        interval: float = 0.1,
+        milestones: int = 10,
+    ):
+        self.total = total
+        self.prefix = prefix
+        self.size = size
+        self.out = out or sys.stdout
+        self.interval = interval
+        self.milestones = milestones
+        self.done = 0
+        self.started = time.monotonic()
+        self.tty = hasattr(self.out, "isatty") and self.out.isatty()
+        self._last_text = None
+        self._last_draw = 0.0
+        self._last_milestone = -1
+        self._draw(force=True)
+
+    def _stats(self) -> str:
+        elapsed = time.monotonic() - self.started
+        if not self.done or elapsed <= 0:
+            return ""
+        rate = self.done / elapsed
+        if self.done >= self.total:
+            return f" {rate:.1f}/s in {format_duration(elapsed)}"
+        return f" {rate:.1f}/s ETA {format_duration((self.total - self.done) / rate)}"
+
+    def _draw(self, force: bool = False) -> None:
+        if not self.tty:
+            milestone = (
+                self.milestones * self.done // self.total
+                if self.total
+                else self.milestones
+            )
+            if milestone != self._last_milestone:
+                self._last_milestone = milestone
+                percent = 100 * self.done // self.total if self.total else 100
+                count = f"{self.done}/{self.total} ({percent}%)"
+                print(
+                    f"{self.prefix}{count}{self._stats()}",
+                    file=self.out,
+                    flush=True,
+                )
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_draw < self.interval:
+            return
+        x = int(self.size * self.done / self.total) if self.total else self.size
+        bar = f"[{u'#'*x}{('-'*(self.size-x))}]"
+        text = f"{self.prefix}{bar} {self.done}/{self.total}{self._stats()}"
+        if text != self._last_text:
+            # pad so a shorter line fully overwrites the previous one
+            padding = " " * max(0, len(self._last_text or "") - len(text))
+            print(text + padding, end="\r", file=self.out, flush=True)
+            self._last_text = text
+            self._last_draw = now
+
+    def update(self, count: int = 1) -> None:
+        self.done += count
+        self._draw(force=self.done >= self.total)
+
+    def close(self) -> None:
+        if self.tty:
+            # a completed run was already drawn by its last update()
+            if self.done < self.total:
+                self._draw(force=True)
+            print("", flush=True, file=self.out)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def progressbar(it, prefix: str, size: int = 60, out=None):
+    with Progress(len(it), prefix, size, out) as progress:
+        for item in it:
+            yield item
+            progress.update()
 
 
 ## Multiprocessing
 
+# one pool per process, reused by every parallel helper call
+_pool = None
+_pool_jobs = None
 
-def init_globals(cntr):
-    global counter
-    counter = cntr
 
+def _init_worker():
+    # Ctrl-C is handled once, in the parent, which then tears the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-def call_and_increment(func, arg):
-    result = func(arg)
-    counter.increment()
-    return result
 
+def get_pool(jobs: int = None):
+    global _pool, _pool_jobs
+    jobs = jobs or multiprocessing.cpu_count()
+    if _pool is None or _pool_jobs != jobs:
+        shutdown_pool()
+        _pool = multiprocessing.Pool(jobs, initializer=_init_worker)
+        _pool_jobs = jobs
+    return _pool
+
+
+def shutdown_pool(terminate: bool = False) -> None:
+    global _pool, _pool_jobs
+    if _pool is None:
+        return
+    if terminate:
+        _pool.terminate()
+    else:
+        _pool.close()
+    _pool.join()
+    _pool = _pool_jobs = None
+
+
+atexit.register(shutdown_pool)
+
+
+def chunksize_for(count: int, jobs: int) -> int:
+    # ~4 chunks per worker keeps IPC overhead low without leaving one worker
+    # holding a long tail; capped so results still stream in steadily
+    return max(1, min(32, count // (jobs * 4)))
+
+
+def _call_indexed(func, indexed_item):
+    index, item = indexed_item
+    return index, func(item)
+
+
+def _call_chunk(func, chunk):
+    return [(index, func(item)) for index, item in chunk]
+
+
+def _imap_jobserver(func, items, jobs, chunksize, tokens):
+    # only run as many chunks at once as we hold job slots: our implicit one plus
+    # any tokens we can get, handed back as soon as there's no work left for them
+    indexed = list(enumerate(items))
+    chunks = collections.deque(
+        indexed[i : i + chunksize] for i in range(0, len(indexed), chunksize)
+    )
+    finished = queue.SimpleQueue()
+    held = []
+    running = 0
+    pool = get_pool(jobs)
+    try:
+        while chunks or running:
+            while chunks and running < 1 + len(held):
+                pool.apply_async(
+                    _call_chunk,
+                    (func, chunks.popleft()),
+                    callback=finished.put,
+                    error_callback=finished.put,
+                )
+                running += 1
+            if chunks and running < jobs:
+                token = tokens.try_acquire()
+                if token:
+                    held.append(token)
+                    continue
+
+            try:
+                # poll so tokens freed by other processes are picked up
+                results = finished.get(timeout=0.05 if chunks else None)
+            except queue.Empty:
+                continue
+            running -= 1
+            if isinstance(results, BaseException):
+                raise results
+            yield from results
+            while held and len(held) >= running + len(chunks):
+                tokens.release(held.pop())
+    finally:
+        for token in held:
+            tokens.release(token)
+        tokens.close()
 
-def do_parallel_progressbar(func, it, prefix: str, size: int = 60, out=sys.stdout):
-    count = len(it)
 
-    def show(j):
-        x = int(size * j / count)
-        print(
-            f"{prefix}[{u'#'*x}{('-'*(size-x))}] {j}/{count}",
-            end="\r",
-            file=out,
-            flush=True,
+def imap_parallel(func, it, jobs: int = None, chunksize: int = None):
+    """Yield (index, result) for func over it, in completion order. Concurrency is
+    limited by the GNU make jobserver when one is advertised (see jobserver.py)."""
+    items = list(it)
+    if not items:
+        return
+    jobs = jobs or multiprocessing.cpu_count()
+    chunksize = chunksize or chunksize_for(len(items), jobs)
+
+    pool = get_pool(jobs)
+    tokens = jobserver.client()
+    done = False
+    try:
+        if tokens:
+            yield from _imap_jobserver(func, items, jobs, chunksize, tokens)
+        else:
+            yield from pool.imap_unordered(
+                partial(_call_indexed, func), enumerate(items), chunksize
+            )
+        done = True
+    finally:
+        # interrupted (or abandoned by the caller): don't leave work queued behind
+        if not done:
+            shutdown_pool(terminate=True)
+
+
+def do_parallel(func, it, jobs: int = None):
+    items = list(it)
+    results = [None] * len(items)
+    for index, result in imap_parallel(func, items, jobs):
+        results[index] = result
+    return results
+
+
+def do_parallel_progressbar(
+    func, it, prefix: str, size: int = 60, out=None, jobs: int = None
+):
+    items = list(it)
+    results = [None] * len(items)
+    with Progress(len(items), prefix, size, out) as progress:
+        for index, result in imap_parallel(func, items, jobs):
+            results[index] = result
+            progress.update()
+    return results
+
+
+def _call_captured(func, item):
+    # capture at the fd level so output from subprocesses (e.g. clang-format) is
+    # buffered along with anything printed from Python
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        try:
+            result = func(item)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, target in zip(saved, (1, 2)):
+                os.dup2(fd, target)
+                os.close(fd)
+        out.seek(0)
+        err.seek(0)
+        return result, out.read(), err.read()
+
+
+def _emit(data: bytes, stream) -> None:
+    if data:
+        # one write per job, so concurrent jobs never interleave mid-line
+        getattr(stream, "buffer", stream).write(data)
+        stream.flush()
+
+
+def do_parallel_buffered(func, it, jobs: int = None, ordered: bool = False):
+    """Like do_parallel, but each job's stdout/stderr is captured and written out
+    in one piece when it finishes (or, if ordered, in submission order)."""
+    # looked up per call: `dbt server` children rebind sys.stdout/sys.stderr
+    out, err = sys.stdout, sys.stderr
+    items = list(it)
+    results = [None] * len(items)
+    held = {}
+    next_index = 0
+    for index, (result, stdout, stderr) in imap_parallel(
+        partial(_call_captured, func), items, jobs
+    ):
+        results[index] = result
+        if not ordered:
+            _emit(stdout, out)
+            _emit(stderr, err)
+            continue
+        held[index] = stdout, stderr
+        while next_index in held:
+            stdout, stderr = held.pop(next_index)
+            _emit(stdout, out)
+            _emit(stderr, err)
+            next_index += 1
+    return results
+
+
+## Running external commands
+
+
+@dataclass
+class CommandResult:
+    args: list
+    returncode: int | None  # None when the command timed out
+    stdout: bytes
+    stderr: bytes
+    elapsed: float
+
+    @property
+    def timed_out(self) -> bool:
+        return self.returncode is None
+
+    def echo(self) -> None:
+        # written in one piece so concurrent commands' output never interleaves
+        _emit(self.stdout, sys.stdout)
+        _emit(self.stderr, sys.stderr)
+
+
+# asyncio is imported where it's used: it costs every dbt start ~60ms otherwise
+
+
+async def _run_command(args, input, timeout, capture) -> CommandResult:
+    import asyncio
+
+    started = time.perf_counter()
+    pipe = asyncio.subprocess.PIPE if capture else None
+    process = await asyncio.create_subprocess_exec(
+        *(str(arg) for arg in args),
+        stdin=asyncio.subprocess.DEVNULL if input is None else asyncio.subprocess.PIPE,
+        stdout=pipe,
+        stderr=pipe,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+        returncode = process.returncode
+    except asyncio.TimeoutError:
+        process.kill()
+        stdout, stderr = await process.communicate()
+        returncode = None
+    except asyncio.CancelledError:
+        # Ctrl-C, or another command failed to start: don't leave this one behind
+        process.kill()
+        await process.wait()
+        raise
+    return CommandResult(
+        list(args),
+        returncode,
+        stdout or b"",
+        stderr or b"",
+        time.perf_counter() - started,
+    )
+
+
+async def _run_many(commands, jobs, timeout, inputs, on_complete, capture):
+    import asyncio
+
+    slots = asyncio.Semaphore(jobs)
+    tokens = jobserver.client()
+    running = 0
+
+    async def run(index, args, input):
+        nonlocal running
+        async with slots:
+            # as in imap_parallel: one implicit job slot, the rest from the jobserver
+            token = None
+            if tokens:
+                while running and (token := tokens.try_acquire()) is None:
+                    await asyncio.sleep(0.05)
+            running += 1
+            try:
+                result = await _run_command(args, input, timeout, capture)
+            finally:
+                running -= 1
+                if token:
+                    tokens.release(token)
+        if on_complete:
+            on_complete(index, result)
+        return result
+
+    try:
+        return await asyncio.gather(
+            *(
+                run(index, args, input)
+                for index, (args, input) in enumerate(zip(commands, inputs))
+            )
         )
+    finally:
+        if tokens:
+            tokens.close()
+
 
-    show(0)
+def run_many(
+    commands,
+    jobs: int = None,
+    timeout: float = None,
+    input=None,
+    on_complete=None,
+    capture: bool = True,
+) -> list:
+    """Run external commands concurrently, straight from an asyncio event loop
+    rather than a Python worker per command. Returns a CommandResult per command,
+    in order. `input` is bytes for every command's stdin, or a list with one entry
+    per command; `on_complete(index, result)` is called as each one finishes."""
+    import asyncio
 
-    counter = Counter()
-    pool = multiprocessing.Pool(
-        multiprocessing.cpu_count(), initializer=init_globals, initargs=(counter,)
+    commands = list(commands)
+    if not commands:
+        return []
+    inputs = input if isinstance(input, list) else [input] * len(commands)
+    return asyncio.run(
+        _run_many(
+            commands,
+            jobs or multiprocessing.cpu_count(),
+            timeout,
+            inputs,
+            on_complete,
+            capture,
+        )
     )
-    result = pool.map_async(partial(call_and_increment, func), it)
-    while not result.ready():
-        show(counter.value)
-        time.sleep(0.1)
-    show(counter.value)
-    pool.close()
-    pool.join()
-    print("", flush=True, file=out)
-    return result.get()
 
 
 # Environment extraction
@@ -197,8 +676,691 @@ def get_environment_from_batch_command(env_cmd, initial=None):
     return result
 
 
+def get_environment_from_shell_script(script, initial=None):
+    """
+    Source a POSIX shell script and return the environment it leaves behind.
+    The script's own output is sent to stderr.
+    """
+    dump = "import json, os; print(json.dumps(dict(os.environ)))"
+    # $0 is "dbt": dbtenv.sh refuses to run unless sourced from dbt or a shell
+    source = '. "$1" >&2 && "$2" -E -c "$3"'
+    proc = subprocess.run(
+        ["bash", "-c", source, "dbt", script, sys.executable, dump],
+        stdout=subprocess.PIPE,
+        env=initial,
+        text=True,
+    )
+    if proc.returncode != 0:
+        return None
+    return json.loads(proc.stdout)
+
+
+# set by the shell itself rather than the env script
+VOLATILE_ENVIRONMENT = {"_", "SHLVL", "PWD", "OLDPWD"}
+
+
+def environment_delta(before: dict, after: dict) -> dict:
+    # values that merely wrap the old one (e.g. PATH prepends) are stored as
+    # [prefix, suffix] so the delta stays valid when the base value changes
+    delta = {}
+    for key, value in after.items():
+        old = before.get(key)
+        if old == value or key in VOLATILE_ENVIRONMENT:
+            continue
+        if old and old in value:
+            delta[key] = list(value.split(old, 1))
+        else:
+            delta[key] = value
+    for key in before.keys() - after.keys() - VOLATILE_ENVIRONMENT:
+        delta[key] = None
+    return delta
+
+
+def apply_environment_delta(delta: dict) -> None:
+    for key, value in delta.items():
+        if value is None:
+            os.environ.pop(key, None)
+        elif isinstance(value, list):
+            prefix, suffix = value
+            os.environ[key] = prefix + os.environ.get(key, "") + suffix
+        else:
+            os.environ[key] = value
+
+
 def get_dbt_version():
-    return open(get_git_root() / "toolchain" / "REQUIRED_VERSION").readline().rstrip()
+    return get_context().toolchain_version
+
+
+## Persistent caches
+
+
+def get_cache_dir() -> Path:
+    path = get_context().build_dir / ".dbt"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def is_configured(build_dir: Path = Path("build")) -> bool:
+    # build/ also holds dbt's caches, so check for CMake's own output instead
+    return (build_dir / "CMakeCache.txt").exists()
+
+
+def read_json_cache(path: Path, default=None):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def file_hash(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def write_json_cache(path: Path, data) -> None:
+    # write to a sibling file and rename so concurrent readers never see a partial file
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError:
+        # caches are an optimisation, never fail a task over one
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+class ContentCache:
+    """Content-addressed blobs under build/.dbt/<name>, one file per key. Reading a
+    blob marks it as used; once the cache outgrows max_bytes, the least recently
+    used blobs are pruned (checked at most every PRUNE_INTERVAL seconds)."""
+
+    MAX_BYTES = 128 << 20
+    PRUNE_INTERVAL = 600
+    # prune down to this share of max_bytes, so one run doesn't prune again
+    PRUNE_TO = 0.8
+
+    def __init__(self, name: str, max_bytes: int = MAX_BYTES):
+        self.path = get_cache_dir() / name
+        self.max_bytes = max_bytes
+        self.checked = False
+
+    def _blob(self, key: str) -> Path:
+        return self.path / key[:2] / key[2:]
+
+    def get(self, key: str):
+        blob = self._blob(key)
+        try:
+            data = blob.read_bytes()
+            os.utime(blob)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        blob = self._blob(key)
+        tmp = blob.with_name(f"{blob.name}.{os.getpid()}.tmp")
+        try:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(data)
+            os.replace(tmp, blob)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            return
+        if not self.checked:
+            self.checked = True
+            self._maybe_prune()
+
+    def _maybe_prune(self) -> None:
+        stamp = self.path / ".pruned"
+        try:
+            if time.time() - stamp.stat().st_mtime < self.PRUNE_INTERVAL:
+                return
+        except OSError:
+            pass
+        stamp.touch()
+        self.prune()
+
+    def prune(self) -> None:
+        blobs = []
+        total = 0
+        with os.scandir(self.path) as it:
+            directories = [d.path for d in it if d.is_dir(follow_symlinks=False)]
+        for directory in directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        stat = entry.stat(follow_symlinks=False)
+                        blobs.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                        total += stat.st_size
+            except OSError:
+                continue  # pruned concurrently by another dbt
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(blobs):
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_bytes * self.PRUNE_TO:
+                break
+
+
+class ResultCache:
+    """Per-file task results under build/.dbt/results, valid while the file (size,
+    mtime, or failing those its content hash) and the tool version and config
+    that produced the result are unchanged."""
+
+    VERSION = 1
+
+    def __init__(self, name: str, tool_version: str):
+        self.path = get_cache_dir() / "results" / f"{name}.json"
+        self.salt = f"{self.VERSION}\0{tool_version}"
+        cached = read_json_cache(self.path, {})
+        valid = cached.get("salt") == self.salt
+        self.entries = cached.get("entries", {}) if valid else {}
+        self.dirty = False
+
+    def get(self, path, config: str = ""):
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry is None or entry["config"] != config:
+            return None
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return None
+        if stat.st_size != entry["size"]:
+            return None
+        if stat.st_mtime_ns != entry["mtime"]:
+            # touched (e.g. by a checkout) but maybe not changed
+            if file_hash(key) != entry["hash"]:
+                return None
+            entry["mtime"] = stat.st_mtime_ns
+            self.dirty = True
+        return entry["result"]
+
+    def put(self, path, result, config: str = "") -> None:
+        key = os.path.abspath(path)
+        try:
+            stat = os.stat(key)
+            digest = file_hash(key)
+        except OSError:
+            self.entries.pop(key, None)
+            return
+        self.entries[key] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": digest,
+            "config": config,
+            "result": result,
+        }
+        self.dirty = True
+
+    def save(self) -> None:
+        if self.dirty:
+            self.path.parent.mkdir(exist_ok=True)
+            write_json_cache(self.path, {"salt": self.salt, "entries": self.entries})
+            self.dirty = False
+
+
+## Toolchain tools
+
+# Bump when the tool index layout changes
+TOOL_INDEX_VERSION = 2
+
+# tool name -> arguments that print its version (None: no safe way to ask)
+TOOLS = {
+    "clang-format": ["--version"],
+    "arm-none-eabi-gdb": ["--version"],
+    "openocd": ["--version"],
+    "JLinkGDBServerCL": None,
+    "cmake": ["--version"],
+    "ninja": ["--version"],
+}
+
+# well-known install locations for tools that aren't shipped in the toolchain
+TOOL_FALLBACKS = {
+    "JLinkGDBServerCL": ["C:\\Program Files\\SEGGER\\JLink\\JLinkGDBServerCL"],
+}
+
+EXEC_SUFFIXES = (".exe", "") if sys.platform == "win32" else ("",)
+
+
+def _tool_names() -> dict:
+    return {name + suffix: name for name in TOOLS for suffix in EXEC_SUFFIXES}
+
+
+def _find_toolchain_tools(toolchain_dir: Path) -> dict:
+    # breadth first, so the shallowest copy wins and we stop once all are found
+    names = _tool_names()
+    found = {}
+    level = [str(toolchain_dir)]
+    while level and len(found) < len(TOOLS):
+        next_level = []
+        for directory in sorted(level):
+            try:
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError:
+                continue
+            for entry in entries:
+                # not following links, which could loop forever
+                if entry.is_dir(follow_symlinks=False):
+                    next_level.append(entry.path)
+                elif entry.name in names and os.access(entry.path, os.X_OK):
+                    found.setdefault(names[entry.name], os.path.abspath(entry.path))
+        level = next_level
+    return found
+
+
+def _find_fallback_tool(name: str):
+    for candidate in TOOL_FALLBACKS.get(name, ()):
+        for suffix in EXEC_SUFFIXES:
+            if os.path.isfile(candidate + suffix):
+                return candidate + suffix
+    return None
+
+
+def _tool_version(result) -> str:
+    if result.returncode != 0:
+        return None
+    for output in (result.stdout, result.stderr):
+        lines = output.decode(errors="replace").strip().splitlines()
+        if lines:
+            return lines[0].strip()
+    return None
+
+
+@cache
+def _find_installed_tool(name: str):
+    path = shutil.which(name) or _find_fallback_tool(name)
+    return os.path.abspath(path) if path else None
+
+
+def _tool_entries(paths: dict) -> dict:
+    probed = [name for name in paths if TOOLS[name]]
+    try:
+        results = run_many(([paths[name]] + TOOLS[name] for name in probed), timeout=10)
+    except OSError:
+        results = []
+    versions = {name: _tool_version(result) for name, result in zip(probed, results)}
+
+    entries = {}
+    for name, path in paths.items():
+        stat = os.stat(path)
+        entries[name] = {
+            "path": path,
+            "version": versions.get(name),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+        }
+    return entries
+
+
+def _is_tool_entry_valid(entry: dict) -> bool:
+    try:
+        stat = os.stat(entry["path"])
+    except OSError:
+        return False
+    return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime"]
+
+
+def _tool_index_path() -> Path:
+    return get_cache_dir() / "toolchain-index.json"
+
+
+def _tool_index_key() -> list:
+    # not PATH: shells and editors with different ones would keep rebuilding it
+    context = get_context()
+    return [
+        TOOL_INDEX_VERSION,
+        sys.platform,
+        context.toolchain_version,
+        str(context.toolchain_dir.absolute()),
+    ]
+
+
+@cache
+def _load_tool_index() -> dict:
+    """{"key", "tools", "versions"}: the tools shipped in the toolchain, found with
+    one walk per toolchain, and the versions of tools found elsewhere, by path."""
+    key = _tool_index_key()
+    cached = read_json_cache(_tool_index_path(), {})
+    if cached.get("key") == key and all(
+        map(_is_tool_entry_valid, cached["tools"].values())
+    ):
+        return cached
+
+    context = get_context()
+    tools = _tool_entries(_find_toolchain_tools(context.toolchain_dir))
+    index = {"key": key, "tools": tools, "versions": {}}
+    write_json_cache(_tool_index_path(), index)
+    return index
+
+
+def get_tool_index() -> dict:
+    """Tool name -> {"path", "version"} for the tools in TOOLS that the toolchain
+    ships, built once per toolchain and then only re-verified with a stat per tool."""
+    return _load_tool_index()["tools"]
+
+
+def find_tool(name: str):
+    """Absolute path of a tool from TOOLS, or None if it isn't installed. Tools the
+    toolchain doesn't ship are looked up on PATH, so newly installed ones are found."""
+    entry = get_tool_index().get(name)
+    if entry:
+        return entry["path"]
+    return _find_installed_tool(name) if name in TOOLS else None
+
+
+def get_tool(name: str, fallback: str = None) -> str:
+    """Like find_tool, but falls back to `fallback` (or the bare name) so the
+    error comes from trying to run it."""
+    return find_tool(name) or fallback or name
+
+
+def get_tool_version(name: str) -> str:
+    entry = get_tool_index().get(name)
+    if entry is None:
+        path = find_tool(name)
+        if path is None:
+            return ""
+        # probed once per binary, whichever PATH it was found through
+        index = _load_tool_index()
+        entry = index["versions"].get(path)
+        if entry is None or not _is_tool_entry_valid(entry):
+            entry = index["versions"][path] = _tool_entries({name: path})[name]
+            write_json_cache(_tool_index_path(), index)
+    return entry["version"] or ""
+
+
+## File discovery
+
+# the *.cc, *.hh, *.[ch]xx, *.[ch]pp and *.[ch] patterns, as name suffixes
+SOURCE_SUFFIXES = (".cc", ".hh", ".cxx", ".hxx", ".cpp", ".hpp", ".c", ".h")
+
+# never descended into (relative to the firmware root)
+PRUNED_DIRECTORIES = ("build", "toolchain", ".git")
+
+WALK_CACHE_VERSION = 2
+
+
+def _translate_ignore_pattern(pattern: str) -> str:
+    # gitignore globbing: * and ? stop at /, ** spans directories
+    anchored = "/" in pattern
+    pattern = pattern.removeprefix("/")
+    regex, i, n = "", 0, len(pattern)
+    while i < n:
+        at_segment = i == 0 or pattern[i - 1] == "/"
+        if at_segment and pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        if at_segment and pattern.startswith("**", i) and i + 2 == n:
+            regex += ".*"
+            i += 2
+            continue
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "\\" and i < n:
+            regex += re.escape(pattern[i])
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 1 if pattern[i : i + 1] in ("!", "]") else i)
+            if end == -1:
+                regex += "\\["
+                continue
+            body = pattern[i:end].replace("\\", "\\\\")
+            i = end + 1
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            regex += f"[{body}]"
+        else:
+            regex += re.escape(c)
+    # without a slash (other than a trailing one) a pattern matches at any depth
+    return regex if anchored else "(?:.*/)?" + regex
+
+
+class IgnoreMatcher:
+    """gitignore-style ignore patterns, e.g. .clang-format-ignore, relative to the
+    directory they were read from: `name` matches at any depth, `a/b` and `/a` are
+    anchored, a trailing / only matches directories, ** spans directories and a
+    leading ! re-includes. The last matching pattern wins."""
+
+    def __init__(self, patterns, base: Path):
+        self.base = os.path.abspath(base)
+        self.patterns = []
+        rules = []
+        for line in patterns:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            self.patterns.append(line)
+            negated = line.startswith("!")
+            if negated or line.startswith("\\#") or line.startswith("\\!"):
+                line = line[1:]
+            directory_only = line.endswith("/")
+            regex = _translate_ignore_pattern(line.rstrip("/"))
+            rules.append((regex, negated, directory_only))
+        self.directories = self._compile(rules)
+        self.files = self._compile([rule for rule in rules if not rule[2]])
+
+    @staticmethod
+    def _compile(rules):
+        # one regex for all patterns, with the alternation reversed so the first
+        # alternative to match is the last pattern in the file
+        if not rules:
+            return None, ()
+        rules = rules[::-1]
+        regex = "|".join(f"({regex})" for regex, _, _ in rules)
+        return re.compile(regex), tuple(negated for _, negated, _ in rules)
+
+    @classmethod
+    def from_file(cls, path: Path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(f, Path(path).parent)
+        except FileNotFoundError:
+            return cls((), Path(path).parent)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def key(self) -> list:
+        return [self.base] + self.patterns
+
+    def match_relative(self, path: str, is_dir: bool) -> bool:
+        """Match a /-separated path relative to the base, not looking at parents."""
+        regex, negated = self.directories if is_dir else self.files
+        if regex is None:
+            return False
+        match = regex.fullmatch(path)
+        return match is not None and not negated[match.lastindex - 1]
+
+    def match(self, path, is_dir: bool = None) -> bool:
+        # like git, anything inside an ignored directory is ignored too
+        relative = os.path.relpath(os.path.abspath(path), self.base)
+        if relative == os.curdir or relative.startswith(os.pardir):
+            return False
+        parts = relative.split(os.sep)
+        for i in range(1, len(parts)):
+            if self.match_relative("/".join(parts[:i]), True):
+                return True
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+        return self.match_relative("/".join(parts), is_dir)
+
+
+def _walk(top: str, suffixes: tuple, recursive: bool, ignore) -> tuple:
+    root = get_context().root
+    pruned = {os.path.abspath(root / d) for d in PRUNED_DIRECTORIES}
+
+    # ignore patterns are matched against paths relative to their base directory
+    relative_top = None
+    if ignore:
+        relative_top = os.path.relpath(os.path.abspath(top), ignore.base)
+        if relative_top.startswith(os.pardir):
+            relative_top = None
+        else:
+            relative_top = "" if relative_top == os.curdir else relative_top
+            relative_top = relative_top.replace(os.sep, "/")
+
+    files, directories = [], {}
+    stack = [(top, relative_top)]
+    while stack:
+        directory, relative = stack.pop()
+        try:
+            directories[directory] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirectories = []
+        for entry in entries:
+            entry_relative = None
+            if relative is not None:
+                entry_relative = f"{relative}/{entry.name}" if relative else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if not recursive or os.path.abspath(entry.path) in pruned:
+                    continue
+                # ignored subtrees are never read
+                if entry_relative and ignore.match_relative(entry_relative, True):
+                    continue
+                subdirectories.append((entry.path, entry_relative))
+            elif entry.name.endswith(suffixes):
+                if entry_relative and ignore.match_relative(entry_relative, False):
+                    continue
+                files.append(entry.path)
+        stack.extend(reversed(subdirectories))
+    return files, directories
+
+
+def find_files(
+    path: Path,
+    suffixes: tuple,
+    recursive: bool = True,
+    ignore: IgnoreMatcher = None,
+    cache: bool = False,
+) -> list:
+    """Single scandir pass over path collecting files ending in one of suffixes.
+    Directories and files matched by `ignore` are skipped during the walk. With
+    cache, the list is reused while no directory's mtime has changed (adding,
+    removing or renaming an entry bumps it)."""
+    top = str(path)
+    ignore = ignore or None
+    if not cache:
+        return [Path(f) for f in _walk(top, suffixes, recursive, ignore)[0]]
+
+    key = json.dumps(
+        [
+            WALK_CACHE_VERSION,
+            os.path.abspath(top),
+            suffixes,
+            recursive,
+            ignore.key() if ignore else None,
+        ]
+    )
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    cache_path = get_cache_dir() / "walk" / f"{digest}.json"
+    cached = read_json_cache(cache_path, {})
+    # stored relative to path, which may be given relative or absolute
+    base = os.path.abspath(top)
+    directories = cached.get("directories")
+    if directories:
+        try:
+            if all(
+                os.stat(os.path.join(base, d)).st_mtime_ns == mtime
+                for d, mtime in directories.items()
+            ):
+                return [Path(top, f) for f in cached["files"]]
+        except OSError:
+            pass
+
+    files, directories = _walk(base, suffixes, recursive, ignore)
+    cached = {
+        "files": [os.path.relpath(f, base) for f in files],
+        "directories": {os.path.relpath(d, base): m for d, m in directories.items()},
+    }
+    cache_path.parent.mkdir(exist_ok=True)
+    write_json_cache(cache_path, cached)
+    return [Path(top, f) for f in cached["files"]]
+
+
+## Up-to-date checking
+
+
+def expand_patterns(patterns) -> list:
+    # patterns are globs relative to the firmware root (or absolute); Paths are literal
+    root = get_context().root
+    files = set()
+    for pattern in patterns:
+        if isinstance(pattern, Path):
+            files.add(pattern.absolute())
+            continue
+        for match in glob.glob(pattern, root_dir=root, recursive=True):
+            files.add((root / match).absolute())
+    return sorted(files)
+
+
+def _fingerprint(files) -> tuple:
+    digest = hashlib.sha1()
+    newest, oldest = 0, None
+    for path in files:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None, newest, oldest
+        digest.update(f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode())
+        newest = max(newest, stat.st_mtime_ns)
+        oldest = stat.st_mtime_ns if oldest is None else min(oldest, stat.st_mtime_ns)
+    return digest.hexdigest(), newest, oldest
+
+
+def _stamp_path(name: str) -> Path:
+    path = get_cache_dir() / "stamps"
+    path.mkdir(exist_ok=True)
+    return path / f"{name}.json"
+
+
+def is_up_to_date(name: str, argv, inputs, outputs) -> bool:
+    """True if `name` last succeeded with the same arguments, no input changed
+    since, and its outputs are still the ones it produced and newer than the inputs.
+    """
+    stamp = read_json_cache(_stamp_path(name))
+    if not stamp or stamp["argv"] != list(argv):
+        return False
+    input_files = expand_patterns(inputs)
+    output_files = expand_patterns(outputs)
+    if not output_files:
+        return False
+    inputs_digest, newest_input, _ = _fingerprint(input_files)
+    outputs_digest, _, oldest_output = _fingerprint(output_files)
+    if outputs_digest is None:
+        return False
+    # tasks that rewrite their inputs in place (license) can only be judged by
+    # the fingerprints, their files' mtimes say nothing about each other
+    in_place = not set(input_files).isdisjoint(output_files)
+    if not in_place and newest_input > oldest_output:
+        return False
+    return stamp["inputs"] == inputs_digest and stamp["outputs"] == outputs_digest
+
+
+def record_up_to_date(name: str, argv, inputs, outputs) -> None:
+    inputs_digest, _, _ = _fingerprint(expand_patterns(inputs))
+    outputs_digest, _, _ = _fingerprint(expand_patterns(outputs))
+    write_json_cache(
+        _stamp_path(name),
+        {"argv": list(argv), "inputs": inputs_digest, "outputs": outputs_digest},
+    )
 
 
 def ensure_midi_port(type, midi, port, default_port_index=-1):
@@ -0,0 +1,192 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# File watching for `dbt format --watch`: inotify (through ctypes, no extra
+# dependencies) where available, otherwise polling mtimes. Both report the set of
+# changed files, and watch() coalesces bursts (saves, checkouts) into one batch.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; followed by the name
+
+
+def _walk_directories(directories, skip_directory):
+    stack = [str(d) for d in directories]
+    while stack:
+        directory = stack.pop()
+        yield directory
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False) and not skip_directory(
+                        entry.path
+                    ):
+                        stack.append(entry.path)
+        except OSError:
+            continue
+
+
+class InotifyWatcher:
+    def __init__(self, directories, skip_directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.skip_directory = skip_directory
+        self.directories = {}
+        self.overflowed = False
+        for directory in _walk_directories(directories, skip_directory):
+            self._watch(directory)
+
+    def _watch(self, directory: str) -> None:
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            self.directories[wd] = directory
+
+    def wait(self, timeout: float = None) -> set:
+        """Changed paths, or an empty set if nothing changed within timeout. Sets
+        `overflowed` when the kernel dropped events (everything may have changed)."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.directories[wd]
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                # new (or moved in) directories are watched, and their files reported
+                if mask & (IN_CREATE | IN_MOVED_TO) and not self.skip_directory(path):
+                    for subdirectory in _walk_directories([path], self.skip_directory):
+                        self._watch(subdirectory)
+                        changed.update(_files_in(subdirectory))
+                continue
+            if name:
+                changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def _files_in(directory: str):
+    try:
+        with os.scandir(directory) as it:
+            return [entry.path for entry in it if entry.is_file()]
+    except OSError:
+        return []
+
+
+class PollingWatcher:
+    def __init__(self, directories, skip_directory, interval: float = 1.0):
+        self.roots = list(directories)
+        self.skip_directory = skip_directory
+        self.interval = interval
+        self.overflowed = False
+        self.snapshot = self._scan()
+
+    def _scan(self) -> dict:
+        snapshot = {}
+        for directory in _walk_directories(self.roots, self.skip_directory):
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            snapshot[entry.path] = entry.stat().st_mtime_ns
+            except OSError:
+                continue
+        return snapshot
+
+    def wait(self, timeout: float = None) -> set:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is None:
+                time.sleep(self.interval)
+            else:
+                time.sleep(min(self.interval, max(remaining, 0)))
+            snapshot = self._scan()
+            changed = {
+                path
+                for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)
+            }
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self) -> None:
+        pass
+
+
+def create(directories, skip_directory):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directories, skip_directory)
+        except (OSError, AttributeError):
+            # no inotify (or no libc symbol for it): fall back to polling
+            pass
+    return PollingWatcher(directories, skip_directory)
+
+
+def watch(watcher, on_change, debounce: float = 0.3, max_delay: float = 5.0):
+    """Call on_change(paths, overflowed) for every burst of changes: collection goes
+    on until nothing has changed for `debounce` seconds, or for at most `max_delay`."""
+    while True:
+        changed = watcher.wait()
+        if not changed and not watcher.overflowed:
+            continue
+        started = time.monotonic()
+        while True:
+            remaining = max_delay - (time.monotonic() - started)
+            if remaining <= 0:
+                break
+            more = watcher.wait(min(debounce, remaining))
+            if not more:
+                break
+            changed |= more
+        overflowed, watcher.overflowed = watcher.overflowed, False
+        on_change(changed, overflowed)
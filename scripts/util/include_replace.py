@@ -12,6 +12,10 @@ import argparse
 import pprint
 import in_place
 
+# share the progress reporting used by the dbt tasks
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tasks"))
+from util import progressbar
+
 pp = pprint.PrettyPrinter(indent=4)
 
 
@@ -40,26 +44,6 @@ def reduce_rename_map(filemap) -> Tuple[bool, str]:
     return (reduced, filemap)
 
 
-# from https://stackoverflow.com/a/34482761
-def progressbar(it, prefix: str, size: int = 60, out=sys.stdout):
-    count = len(it)
-
-    def show(j):
-        x = int(size * j / count)
-        print(
-            f"{prefix}[{u'#'*x}{('-'*(size-x))}] {j}/{count}",
-            end="\r",
-            file=out,
-            flush=True,
-        )
-
-    show(0)
-    for i, item in enumerate(it):
-        yield item
-        show(i + 1)
-    print("\n", flush=True, file=out)
-
-
 def main():
     parser = argparse.ArgumentParser(description="Process files for include changes.")
     parser.add_argument(